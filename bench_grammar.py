@@ -0,0 +1,142 @@
+# Файл bench_grammar.py - сравнение бэкендов модели грамматики
+#
+# Запуск: python bench_grammar.py [--sentences файл.txt] [--batch-size 16] [--threads 4] [--json]
+#
+# Каждый бэкенд загружается в отдельном процессе, чтобы RSS не смешивались.
+# Выводятся время загрузки, задержка на пакет, пропускная способность, RSS
+# и доля исправлений, совпадающих с эталонным fp32 pipeline.
+import argparse
+import json
+import multiprocessing
+import resource
+import statistics
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+SAMPLE_SENTENCES = [
+    "Современные информационные технологии играют важную роль в развитии общества.",
+    "Результаты исследования показывают что предложеный метод позволяет повысить эффективность.",
+    "Анализ финансовой отчетности позволяет выявить ключевые проблемы предприятия и определить пути их решения.",
+    "В рамках первой главы были рассмотрены теоретические основы управления персоналом организации.",
+    "Данная проблема являеться актуальной для многих российских компаний в настоящее время.",
+    "Эффективность использования ресурсов напрямую зависит от качества принимаемых управленческих решений.",
+    "Для решения поставленых задач были использованы методы сравнительного анализа и синтеза.",
+    "Полученые данные свидетельствуют о необходимости совершенствования существующей системы контроля.",
+    "Цифровая трансформация экономики требует пересмотра традиционных подходов к организации бизнеса.",
+    "Исследование проводилось на базе крупного промышленного предприятия в течении двух лет.",
+    "Основными факторами влияющими на конкурентоспособность являются качество продукции и цена.",
+    "В заключении следует отметить, что цели работы были достигнуты в полном обьеме.",
+    "Предложенные рекомендации могут быть использованы в практической деятельности организаций.",
+    "Особое внимание уделяется вопросам информационной безопасности и защиты персональных данных.",
+    "Методика оценки риска включает несколько этапов, каждый из которых имеет свои особенности.",
+    "Несмотря на очевидные преимущества внедрение новых технологий сопряжено с определенными трудностями.",
+]
+
+
+def read_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def run_backend(backend, sentences, batch_size, threads, latency_budget_ms, runs):
+    import torch
+    from transformers import pipeline
+    from bot import GRAMMAR_MODEL_NAME, GRAMMAR_GENERATION_PARAMS, QuantizedGrammarModel
+
+    if threads:
+        torch.set_num_threads(threads)
+
+    rss_before = read_rss_mb()
+    started_at = time.perf_counter()
+    if backend == 'quantized':
+        model = QuantizedGrammarModel(threads=threads, latency_budget_ms=latency_budget_ms)
+    else:
+        model = pipeline("text2text-generation", model=GRAMMAR_MODEL_NAME, device=-1)
+    load_time = time.perf_counter() - started_at
+
+    # Сортировка по длине, как в EnhancedAcademicWriter._correct_sentences
+    ordered = sorted(range(len(sentences)), key=lambda i: len(sentences[i]))
+    batches = [ordered[start:start + batch_size] for start in range(0, len(ordered), batch_size)]
+
+    model([sentences[0]], batch_size=1, **GRAMMAR_GENERATION_PARAMS)
+
+    latencies = []
+    outputs = list(sentences)
+    total_time = 0.0
+    for _ in range(runs):
+        for batch in batches:
+            batch_started_at = time.perf_counter()
+            results = model([sentences[i] for i in batch], batch_size=len(batch), **GRAMMAR_GENERATION_PARAMS)
+            latency = time.perf_counter() - batch_started_at
+            latencies.append(latency)
+            total_time += latency
+            for i, result in zip(batch, results):
+                if isinstance(result, list):
+                    result = result[0]
+                outputs[i] = result['generated_text']
+
+    return {
+        'backend': backend,
+        'num_beams': getattr(model, 'num_beams', GRAMMAR_GENERATION_PARAMS['num_beams']),
+        'load_time_s': load_time,
+        'batch_latency_ms_p50': statistics.median(latencies) * 1000,
+        'batch_latency_ms_max': max(latencies) * 1000,
+        'sentences_per_s': len(sentences) * runs / total_time if total_time else 0.0,
+        'rss_mb': read_rss_mb(),
+        'rss_model_mb': read_rss_mb() - rss_before,
+        'outputs': outputs,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк бэкендов модели грамматики")
+    parser.add_argument('--sentences', help="файл с предложениями, по одному в строке")
+    parser.add_argument('--batch-size', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--budget-ms', type=float, default=300)
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help="вывести результаты в JSON")
+    args = parser.parse_args()
+
+    sentences = SAMPLE_SENTENCES
+    if args.sentences:
+        with open(args.sentences, encoding='utf-8') as source:
+            sentences = [line.strip() for line in source if line.strip()]
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for backend in ('pipeline', 'quantized'):
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+            results.append(executor.submit(
+                run_backend, backend, sentences, args.batch_size, args.threads, args.budget_ms, args.runs
+            ).result())
+
+    reference = results[0]['outputs']
+    for result in results:
+        outputs = result.pop('outputs')
+        result['agreement'] = sum(a == b for a, b in zip(outputs, reference)) / len(reference)
+
+    if args.json:
+        print(json.dumps({'sentences': len(sentences), 'batch_size': args.batch_size, 'results': results},
+                         ensure_ascii=False, indent=2))
+        return
+
+    print(f"Предложений: {len(sentences)}, пакет: {args.batch_size}, прогонов: {args.runs}")
+    header = f"{'backend':<10} {'beams':>5} {'load,s':>7} {'p50,ms':>8} {'max,ms':>8} {'sent/s':>7} {'RSS,MB':>7} {'model,MB':>8} {'agree':>6}"
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print(f"{result['backend']:<10} {result['num_beams']:>5} {result['load_time_s']:>7.1f} "
+              f"{result['batch_latency_ms_p50']:>8.0f} {result['batch_latency_ms_max']:>8.0f} "
+              f"{result['sentences_per_s']:>7.1f} {result['rss_mb']:>7.0f} {result['rss_model_mb']:>8.0f} "
+              f"{result['agreement']:>6.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+# Файл bench_html_extract.py - сравнение способов извлечения текста страниц
+#
+# Запуск: python bench_html_extract.py [--pages каталог_с_html] [--runs 5] [--json]
+#
+# Сравниваются полный разбор BeautifulSoup (extract_text_soup) и потоковый
+# разбор lxml (extract_main_text). Для каждого способа выводятся среднее и
+# максимальное время на страницу, пик выделенной памяти (tracemalloc) и
+# средняя длина полученного текста. Без --pages используются синтетические
+# страницы с меню, боковой колонкой и длинной статьей.
+import argparse
+import json
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
+
+from bot import extract_main_text, extract_text_soup
+
+EXTRACTORS = {
+    'bs4': extract_text_soup,
+    'lxml': extract_main_text,
+}
+
+
+def synthetic_pages(count=20):
+    pages = []
+    for n in range(count):
+        menu = "".join(f"<li><a href='/s{i}'>Раздел {i}</a></li>" for i in range(50))
+        sidebar = "".join(f"<p>Похожая статья {i}</p>" for i in range(30))
+        body = "".join(
+            f"<p>Абзац {i} статьи {n}: анализ <b>финансовой</b> устойчивости предприятия "
+            f"и оценка <a href='#'>рисков</a> в современных условиях.</p>"
+            for i in range(300 + 50 * n)
+        )
+        pages.append(
+            f"<html><head><script>var data = {list(range(500))};</script><style>p {{ margin: 0 }}</style></head>"
+            f"<body><header>Журнал</header><nav><ul>{menu}</ul></nav><aside>{sidebar}</aside>"
+            f"<main><article><h1>Статья {n}</h1>{body}</article></main><footer>Подвал</footer></body></html>"
+        )
+    return pages
+
+
+def load_pages(directory):
+    pages = []
+    for path in sorted(Path(directory).glob('*.htm*')):
+        pages.append(path.read_bytes().decode('utf-8', errors='replace'))
+    return pages
+
+
+def measure(extract, pages, runs):
+    times = []
+    for _ in range(runs):
+        for html in pages:
+            started_at = time.perf_counter()
+            extract(html)
+            times.append(time.perf_counter() - started_at)
+
+    peaks = []
+    lengths = []
+    for html in pages:
+        tracemalloc.start()
+        text = extract(html)
+        peaks.append(tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+        lengths.append(len(text))
+
+    return {
+        'mean_ms': statistics.mean(times) * 1000,
+        'max_ms': max(times) * 1000,
+        'peak_kb_mean': statistics.mean(peaks) / 1024,
+        'peak_kb_max': max(peaks) / 1024,
+        'text_chars_mean': statistics.mean(lengths),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк извлечения текста из HTML")
+    parser.add_argument('--pages', help="каталог с сохраненными страницами (*.html)")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--json', action='store_true', help="вывести результаты в JSON")
+    args = parser.parse_args()
+
+    pages = load_pages(args.pages) if args.pages else synthetic_pages()
+    if not pages:
+        parser.error(f"в каталоге {args.pages} нет HTML-файлов")
+
+    results = {name: measure(extract, pages, args.runs) for name, extract in EXTRACTORS.items()}
+
+    if args.json:
+        print(json.dumps({'pages': len(pages), 'runs': args.runs, 'results': results}, ensure_ascii=False, indent=2))
+        return
+
+    size_kb = statistics.mean(len(html.encode('utf-8')) for html in pages) / 1024
+    print(f"Страниц: {len(pages)}, средний размер: {size_kb:.0f} KB, прогонов: {args.runs}")
+    header = f"{'extractor':<10} {'mean,ms':>8} {'max,ms':>8} {'peak,KB':>9} {'max peak,KB':>12} {'chars':>6}"
+    print(header)
+    print('-' * len(header))
+    for name, result in results.items():
+        print(f"{name:<10} {result['mean_ms']:>8.1f} {result['max_ms']:>8.1f} {result['peak_kb_mean']:>9.0f} "
+              f"{result['peak_kb_max']:>12.0f} {result['text_chars_mean']:>6.0f}")
+
+
+if __name__ == "__main__":
+    main()
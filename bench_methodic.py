@@ -0,0 +1,168 @@
+# Файл bench_methodic.py - точность и скорость разбора методичек
+#
+# Запуск: python bench_methodic.py [--dir bench_methodics] [--contains] [--runs 1] [--json]
+#
+# В каталоге лежат методички (PDF, DOCX, TXT) и файл expected.json с ожидаемыми
+# значениями полей: {"файл": {"university_name": "...", "font_size": "14",
+# "required_sections": [...], ...}}. В expected.json перечисляются только поля,
+# которые текущие шаблоны должны извлекать точно; расхождение означает, что
+# поведение извлечения изменилось. Для каждого документа замеряются
+# извлечение текста и каждый метод _extract_* по отдельности, затем
+# extract_methodic_info целиком. Выводятся точность по полям, время этапов,
+# RSS основного процесса (до прогона и пиковый), пиковый RSS процессов
+# разбора PDF и число документов в секунду.
+import argparse
+import asyncio
+import json
+import resource
+import statistics
+import time
+from pathlib import Path
+
+from bot import DocumentProcessor
+
+EXTENSIONS = ('.pdf', '.docx', '.txt')
+STAGES = ['text', 'university', 'structure', 'formatting', 'methodic_info']
+
+
+def read_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def flatten(methodic_info):
+    """Поля methodic_info одним словарем, как в expected.json."""
+    fields = {}
+    fields.update(methodic_info.get('university', {}))
+    fields.update(methodic_info.get('work_structure', {}))
+    fields.update(methodic_info.get('formatting_style', {}))
+    return fields
+
+
+def normalize(value):
+    if isinstance(value, (list, tuple)):
+        return [normalize(item) for item in value]
+    return ' '.join(str(value).split()).casefold().rstrip('.,;: ')
+
+
+def field_matches(expected, actual, contains):
+    expected, actual = normalize(expected), normalize(actual)
+    if isinstance(expected, list):
+        return isinstance(actual, list) and sorted(expected) == sorted(actual)
+    if contains:
+        return expected in actual
+    return expected == actual
+
+
+async def extract_text(processor, path):
+    extension = path.suffix.lower()
+    if extension == '.pdf':
+        return await processor.extract_text_from_pdf(str(path))
+    if extension == '.docx':
+        return processor.extract_text_from_docx(str(path))
+    return await processor.extract_text_from_txt(str(path))
+
+
+async def timed(stage_times, stage, func, *args):
+    started_at = time.perf_counter()
+    result = func(*args)
+    if asyncio.iscoroutine(result):
+        result = await result
+    stage_times[stage].append(time.perf_counter() - started_at)
+    return result
+
+
+async def run(directory, expected, runs, contains):
+    processor = DocumentProcessor()
+    paths = sorted(path for path in Path(directory).iterdir() if path.suffix.lower() in EXTENSIONS)
+    stage_times = {stage: [] for stage in STAGES}
+    hits = {}
+    totals = {}
+    documents = []
+
+    rss_before = read_rss_mb()
+    started_at = time.perf_counter()
+    try:
+        for path in paths:
+            for _ in range(runs):
+                text = await timed(stage_times, 'text', extract_text, processor, path)
+                await timed(stage_times, 'university', processor._extract_university_info, text)
+                await timed(stage_times, 'structure', processor._extract_work_structure, text)
+                await timed(stage_times, 'formatting', processor._extract_formatting_style, text)
+                methodic_info = await timed(stage_times, 'methodic_info', processor.extract_methodic_info, text)
+
+            fields = flatten(methodic_info)
+            mismatches = {}
+            for name, value in expected.get(path.name, {}).items():
+                totals[name] = totals.get(name, 0) + 1
+                if field_matches(value, fields.get(name, ''), contains):
+                    hits[name] = hits.get(name, 0) + 1
+                else:
+                    mismatches[name] = {'expected': value, 'actual': fields.get(name)}
+            documents.append({'file': path.name, 'chars': len(text), 'mismatches': mismatches})
+    finally:
+        # Дожидаемся завершения процессов PDF: RUSAGE_CHILDREN учитывает только их
+        processor.close(wait=True)
+    elapsed = time.perf_counter() - started_at
+
+    accuracy = {name: hits.get(name, 0) / total for name, total in sorted(totals.items())}
+    return {
+        'documents': len(paths),
+        'runs': runs,
+        'docs_per_s': len(paths) * runs / elapsed if elapsed else 0.0,
+        'stage_ms_mean': {
+            stage: statistics.mean(times) * 1000 if times else 0.0 for stage, times in stage_times.items()
+        },
+        'stage_ms_max': {
+            stage: max(times) * 1000 if times else 0.0 for stage, times in stage_times.items()
+        },
+        'rss_before_mb': rss_before,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'peak_pdf_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+        'field_accuracy': accuracy,
+        'overall_accuracy': sum(hits.values()) / sum(totals.values()) if totals else None,
+        'details': documents,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора методичек")
+    parser.add_argument('--dir', default='bench_methodics', help="каталог с методичками и expected.json")
+    parser.add_argument('--contains', action='store_true', help="поле верно, если содержит ожидаемое значение")
+    parser.add_argument('--runs', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="вывести результаты в JSON")
+    args = parser.parse_args()
+
+    expected_path = Path(args.dir) / 'expected.json'
+    expected = json.loads(expected_path.read_text(encoding='utf-8')) if expected_path.exists() else {}
+    results = asyncio.run(run(args.dir, expected, args.runs, args.contains))
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+
+    print(f"Документов: {results['documents']}, прогонов: {results['runs']}, "
+          f"документов в секунду: {results['docs_per_s']:.1f}")
+    print(f"RSS: {results['rss_before_mb']:.0f} MB до прогона, пик {results['peak_rss_mb']:.0f} MB; "
+          f"пик процессов PDF: {results['peak_pdf_worker_rss_mb']:.0f} MB")
+    print(f"\n{'этап':<15} {'mean,ms':>9} {'max,ms':>9}")
+    for stage in STAGES:
+        print(f"{stage:<15} {results['stage_ms_mean'][stage]:>9.1f} {results['stage_ms_max'][stage]:>9.1f}")
+    if results['field_accuracy']:
+        print(f"\n{'поле':<20} {'точность':>8}")
+        for name, accuracy in results['field_accuracy'].items():
+            print(f"{name:<20} {accuracy:>8.0%}")
+        print(f"{'всего':<20} {results['overall_accuracy']:>8.0%}")
+    for document in results['details']:
+        for name, mismatch in document['mismatches'].items():
+            print(f"  {document['file']}: {name}: ожидалось {mismatch['expected']!r}, получено {mismatch['actual']!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+# Файл bench_methodic_fields.py - стоимость поиска полей методички
+#
+# Запуск: python bench_methodic_fields.py [--texts каталог_с_txt] [--pages 300] [--runs 3] [--json]
+#
+# Сравнивается MethodicFieldExtractor с прежним способом: re.findall каждого
+# шаблона по всему тексту с компиляцией при каждом вызове. Выводятся время на
+# документ и число полей, значения которых совпали с прежним способом. Без
+# --texts используются синтетические методички заданного числа страниц.
+import argparse
+import json
+import re
+import statistics
+import time
+from pathlib import Path
+
+from bot import MethodicFieldExtractor
+
+FRONT_MATTER = """МИНИСТЕРСТВО НАУКИ И ВЫСШЕГО ОБРАЗОВАНИЯ РОССИЙСКОЙ ФЕДЕРАЦИИ
+ФГБОУ ВО Российский государственный экономический университет
+Факультет экономики и управления предприятием
+Кафедра финансов и бухгалтерского учета
+Адрес: 117997, г. Москва, Стремянный переулок, дом 36
+"""
+
+REQUIREMENTS = """Структура работы: титульный лист, содержание, введение, глава 1, глава 2, глава 3, заключение, список литературы, приложения.
+Оформление: шрифт Times New Roman, размер шрифта 14 пт, междустрочный интервал полуторный.
+Поля: левое 30 мм, правое 10 мм, верхнее 20 мм, нижнее 20 мм.
+"""
+
+# Длинные абзацы без знаков препинания: на них шаблоны с ленивыми повторами
+# по всему тексту перебирают много начальных позиций
+FILLER = (
+    "Анализ Финансовой Устойчивости Предприятия Проводится На Основе Данных Бухгалтерской Отчетности "
+    "И Включает Оценку Ликвидности Платежеспособности Деловой Активности И Рентабельности "
+) * 6
+
+
+def synthetic_text(pages):
+    body = []
+    for page in range(pages):
+        body.append(FILLER)
+        if page == pages // 2:
+            body.append(REQUIREMENTS)
+    return FRONT_MATTER + "\n".join(body)
+
+
+def legacy_extract(text):
+    """Прежний способ: первый элемент re.findall для первого сработавшего шаблона поля."""
+    found = {}
+    for name, (_, _, _, patterns, flags) in MethodicFieldExtractor.FIELDS.items():
+        for pattern in patterns:
+            matches = re.findall(pattern, text, flags)
+            if matches:
+                found[name] = matches[0]
+                break
+    return found
+
+
+def measure(extract, texts, runs):
+    times = []
+    results = []
+    for text in texts:
+        for _ in range(runs):
+            started_at = time.perf_counter()
+            result = extract(text)
+            times.append(time.perf_counter() - started_at)
+        results.append(result)
+    return times, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк извлечения полей методички")
+    parser.add_argument('--texts', help="каталог с текстами методичек (*.txt)")
+    parser.add_argument('--pages', type=int, default=300, help="страниц в синтетической методичке")
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--json', action='store_true', help="вывести результаты в JSON")
+    args = parser.parse_args()
+
+    if args.texts:
+        texts = [path.read_text(encoding='utf-8', errors='replace') for path in sorted(Path(args.texts).glob('*.txt'))]
+        if not texts:
+            parser.error(f"в каталоге {args.texts} нет файлов *.txt")
+    else:
+        texts = [synthetic_text(args.pages // 4), synthetic_text(args.pages)]
+
+    # Без бюджета времени, чтобы сравнивать полную работу обоих способов
+    extractor = MethodicFieldExtractor(budget_ms=float('inf'))
+    legacy_times, legacy_results = measure(legacy_extract, texts, args.runs)
+    engine_times, engine_results = measure(extractor.extract, texts, args.runs)
+
+    fields = len(MethodicFieldExtractor.FIELDS)
+    agreement = [
+        sum(legacy.get(name) == engine.get(name) for name in MethodicFieldExtractor.FIELDS) / fields
+        for legacy, engine in zip(legacy_results, engine_results)
+    ]
+    results = {
+        'documents': len(texts),
+        'chars_mean': statistics.mean(len(text) for text in texts),
+        'legacy_ms_mean': statistics.mean(legacy_times) * 1000,
+        'legacy_ms_max': max(legacy_times) * 1000,
+        'engine_ms_mean': statistics.mean(engine_times) * 1000,
+        'engine_ms_max': max(engine_times) * 1000,
+        'field_agreement': statistics.mean(agreement),
+    }
+
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+        return
+
+    print(f"Документов: {results['documents']}, средняя длина: {results['chars_mean']:.0f} символов, прогонов: {args.runs}")
+    print(f"{'способ':<10} {'mean,ms':>9} {'max,ms':>9}")
+    print(f"{'findall':<10} {results['legacy_ms_mean']:>9.1f} {results['legacy_ms_max']:>9.1f}")
+    print(f"{'engine':<10} {results['engine_ms_mean']:>9.1f} {results['engine_ms_max']:>9.1f}")
+    print(f"Совпадение полей с прежним способом: {results['field_agreement']:.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,24 +10,27 @@ import io
 import sys
 import random
 import hashlib
+import time
+import zlib
+import tempfile
+from email.utils import parsedate_to_datetime
 from typing import List, Dict
-from collections import Counter
-from threading import Thread
+from collections import Counter, OrderedDict, deque
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import multiprocessing
+from functools import lru_cache, partial
 
-import requests
+import httpx
+import numpy as np
 import PyPDF2
 import docx2txt
 import aiofiles
 from docx import Document
 from docx.shared import Inches, Pt
 from docx.enum.text import WD_ALIGN_PARAGRAPH
-from bs4 import BeautifulSoup
-from googlesearch import search
-from transformers import pipeline
-from sentence_transformers import SentenceTransformer
 import textstat
-import pymorphy3
-from flask import Flask
+from flask import Flask, jsonify
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -44,8 +47,14 @@ def home():
 
 @app.route('/health')
 def health():
+    # Liveness: процесс жив, модели не требуются
     return "OK", 200
 
+@app.route('/ready')
+def ready():
+    is_ready = model_registry.is_ready()
+    return jsonify({'ready': is_ready, 'models': model_registry.snapshot()}), 200 if is_ready else 503
+
 def run_flask():
     port = int(os.getenv("PORT", 8080))
     app.run(host='0.0.0.0', port=port)
@@ -55,6 +64,160 @@ BOT_TOKEN = os.getenv('BOT_TOKEN')
 DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
 DEEPSEEK_API_URL = "https://api.deepseek.com/v1/chat/completions"
 
+# Пул потоков для CPU-задач (грамматика, нормализация, сборка docx)
+CPU_WORKERS = int(os.getenv('CPU_WORKERS', '2'))
+
+# Посекционная генерация: сколько разделов пишется одновременно и максимальный объем одного запроса
+SECTION_CONCURRENCY = int(os.getenv('SECTION_CONCURRENCY', '4'))
+SECTION_MAX_WORDS = int(os.getenv('SECTION_MAX_WORDS', '1500'))
+
+# Кэш ответов DeepSeek: срок жизни записи в часах и предельный объем в мегабайтах
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', 'llm_cache.db')
+LLM_CACHE_TTL_HOURS = float(os.getenv('LLM_CACHE_TTL_HOURS', '720'))
+LLM_CACHE_MAX_MB = float(os.getenv('LLM_CACHE_MAX_MB', '200'))
+
+# Устойчивость клиента DeepSeek: повторы, автомат отключения и лимиты запросов/токенов
+DEEPSEEK_MAX_RETRIES = int(os.getenv('DEEPSEEK_MAX_RETRIES', '4'))
+DEEPSEEK_REQUESTS_PER_SECOND = float(os.getenv('DEEPSEEK_REQUESTS_PER_SECOND', '5'))
+DEEPSEEK_TOKENS_PER_MINUTE = float(os.getenv('DEEPSEEK_TOKENS_PER_MINUTE', '500000'))
+DEEPSEEK_BREAKER_THRESHOLD = int(os.getenv('DEEPSEEK_BREAKER_THRESHOLD', '5'))
+DEEPSEEK_BREAKER_RESET = float(os.getenv('DEEPSEEK_BREAKER_RESET', '30'))
+
+# Модели, загружаемые в фоне после запуска (через запятую); остальные - при первом использовании
+WARMUP_MODELS = [name.strip() for name in os.getenv('WARMUP_MODELS', 'morph,grammar').split(',') if name.strip()]
+SIMILARITY_MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
+
+# Семантическая дедупликация предложений: порог косинусной близости и размер блока матрицы
+SEMANTIC_DEDUP = os.getenv('SEMANTIC_DEDUP', '1') == '1'
+SEMANTIC_DEDUP_THRESHOLD = float(os.getenv('SEMANTIC_DEDUP_THRESHOLD', '0.92'))
+SEMANTIC_DEDUP_BLOCK = int(os.getenv('SEMANTIC_DEDUP_BLOCK', '256'))
+
+# Нормализация слов: размер памяти словоформа -> лемма
+MORPH_CACHE_SIZE = int(os.getenv('MORPH_CACHE_SIZE', '100000'))
+
+# Модель грамматики и параметры генерации (входят в ключ кэша исправлений)
+GRAMMAR_MODEL_NAME = "cointegrated/rut5-base-grammar-correction"
+GRAMMAR_GENERATION_PARAMS = {'max_length': 100, 'num_beams': 2}
+
+# Бэкенд модели грамматики: pipeline (fp32 transformers) или quantized (int8, CPU)
+GRAMMAR_BACKEND = os.getenv('GRAMMAR_BACKEND', 'pipeline')
+GRAMMAR_THREADS = int(os.getenv('GRAMMAR_THREADS', '0'))
+GRAMMAR_LATENCY_BUDGET_MS = float(os.getenv('GRAMMAR_LATENCY_BUDGET_MS', '300'))
+
+# Кэш исправлений грамматики: размер LRU в памяти и число записей на диске
+GRAMMAR_CACHE_PATH = os.getenv('GRAMMAR_CACHE_PATH', 'grammar_cache.db')
+GRAMMAR_CACHE_MEMORY = int(os.getenv('GRAMMAR_CACHE_MEMORY', '20000'))
+GRAMMAR_CACHE_MAX_ENTRIES = int(os.getenv('GRAMMAR_CACHE_MAX_ENTRIES', '500000'))
+
+# Предварительный отбор предложений для модели грамматики
+GRAMMAR_TRIAGE = os.getenv('GRAMMAR_TRIAGE', '1') == '1'
+GRAMMAR_TRIAGE_THRESHOLD = float(os.getenv('GRAMMAR_TRIAGE_THRESHOLD', '1.0'))
+
+# Пакетная проверка грамматики: размер пакета и ожидание добора пакета в секундах
+GRAMMAR_BATCH_SIZE = int(os.getenv('GRAMMAR_BATCH_SIZE', '16'))
+GRAMMAR_BATCH_WAIT = float(os.getenv('GRAMMAR_BATCH_WAIT', '0.05'))
+
+# Очередь генерации: число одновременных работ и максимальная длина очереди
+GENERATION_WORKERS = int(os.getenv('GENERATION_WORKERS', '2'))
+GENERATION_QUEUE_LIMIT = int(os.getenv('GENERATION_QUEUE_LIMIT', '20'))
+
+# Потоковый (SSE) режим DeepSeek и частота обновления прогресса в секундах
+DEEPSEEK_STREAMING = os.getenv('DEEPSEEK_STREAMING', '1') == '1'
+PROGRESS_INTERVAL = float(os.getenv('PROGRESS_INTERVAL', '3'))
+
+# Поиск источников: число запросов и ссылок на запрос, общий срок этапа и
+# таймаут одной страницы в секундах, параллельность на хост, предел размера страницы
+SOURCE_QUERIES = int(os.getenv('SOURCE_QUERIES', '2'))
+SOURCE_RESULTS_PER_QUERY = int(os.getenv('SOURCE_RESULTS_PER_QUERY', '2'))
+SOURCE_STAGE_DEADLINE = float(os.getenv('SOURCE_STAGE_DEADLINE', '15'))
+SOURCE_FETCH_TIMEOUT = float(os.getenv('SOURCE_FETCH_TIMEOUT', '10'))
+SOURCE_HOST_CONCURRENCY = int(os.getenv('SOURCE_HOST_CONCURRENCY', '2'))
+SOURCE_MAX_BYTES = int(os.getenv('SOURCE_MAX_BYTES', str(2 * 1024 * 1024)))
+
+# Кэш страниц источников: срок свежести (потом - условный GET) и общий объем
+PAGE_CACHE_PATH = os.getenv('PAGE_CACHE_PATH', 'page_cache.db')
+PAGE_CACHE_TTL_HOURS = float(os.getenv('PAGE_CACHE_TTL_HOURS', '168'))
+PAGE_CACHE_MAX_MB = float(os.getenv('PAGE_CACHE_MAX_MB', '100'))
+
+# Локальный индекс источников: файл, минимальная доля слов темы в найденном
+# тексте и длина фрагмента методички в символах
+SOURCE_INDEX_PATH = os.getenv('SOURCE_INDEX_PATH', 'source_index.db')
+SOURCE_INDEX_MIN_RELEVANCE = float(os.getenv('SOURCE_INDEX_MIN_RELEVANCE', '0.5'))
+SOURCE_INDEX_PASSAGE = int(os.getenv('SOURCE_INDEX_PASSAGE', '1500'))
+
+# Векторы источников для ранжирования по смыслу (каталог с memmap-файлом)
+SOURCE_VECTORS_PATH = os.getenv('SOURCE_VECTORS_PATH', 'source_vectors')
+
+# Извлечение текста PDF-методичек: предел числа страниц, число титульных
+# страниц, которые берутся всегда, размер порции страниц и число процессов
+PDF_PAGE_BUDGET = int(os.getenv('PDF_PAGE_BUDGET', '60'))
+PDF_FRONT_PAGES = int(os.getenv('PDF_FRONT_PAGES', '3'))
+PDF_CHUNK_PAGES = int(os.getenv('PDF_CHUNK_PAGES', '8'))
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', '2'))
+
+# Извлечение полей методички: бюджет времени на документ и число окрестностей
+# ключевого слова, проверяемых для каждого поля
+METHODIC_EXTRACT_BUDGET_MS = float(os.getenv('METHODIC_EXTRACT_BUDGET_MS', '250'))
+METHODIC_MAX_ANCHORS = int(os.getenv('METHODIC_MAX_ANCHORS', '20'))
+
+# Фоновая обработка методичек: число одновременных задач, предел очереди и
+# число попыток задачи (в том числе после перезапуска бота)
+METHODIC_WORKERS = int(os.getenv('METHODIC_WORKERS', '2'))
+METHODIC_QUEUE_LIMIT = int(os.getenv('METHODIC_QUEUE_LIMIT', '50'))
+METHODIC_JOB_ATTEMPTS = int(os.getenv('METHODIC_JOB_ATTEMPTS', '3'))
+
+# Дополнительный словарь штампов (строки вида "штамп -> замена")
+CLICHES_PATH = os.getenv('CLICHES_PATH', 'cliches.txt')
+
+DEFAULT_CHAPTER_TITLES = {
+    1: "Теоретические основы исследования",
+    2: "Практическое исследование",
+    3: "Анализ и выводы",
+    4: "Результаты и рекомендации",
+    5: "Перспективы развития"
+}
+
+DEFAULT_CLICHES = {
+    "в данной работе": "В исследовании",
+    "актуальность темы заключается": "Значимость изучения обусловлена",
+    "целью работы является": "Основной целью выступает",
+    "задачами работы являются": "Ключевыми задачами исследования определены",
+    "объектом исследования является": "В качестве объекта изучения рассматривается",
+    "предметом исследования является": "Предметная область охватывает",
+    "во введении": "В начальном разделе",
+    "в заключении": "В завершающей части",
+    "было выявлено": "Установлено",
+    "можно сделать вывод": "Следует заключить"
+}
+
+# Признаки грамматических ошибок, общие для отчета о качестве и отбора предложений
+PASSIVE_INFINITIVE_PATTERN = re.compile(r'\b\w+ (?:был|была|было|были) \w+ть\b')
+CASE_BREAK_PATTERN = re.compile(r'[а-яё][А-ЯЁ]')
+
+# Разметка для извлечения текста страниц: служебные разделы, основное
+# содержимое и блоки, из которых собирается текст
+HTML_SKIP_TAGS = {'script', 'style', 'nav', 'footer', 'header', 'noscript', 'aside', 'form'}
+HTML_MAIN_TAGS = {'article', 'main'}
+HTML_TEXT_TAGS = {'p', 'li', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'blockquote', 'pre', 'td', 'dd', 'dt', 'figcaption'}
+
+# Признаки страниц методички с требованиями и ключевые слова полей, которые
+# из нее извлекаются: когда встретились все, дальше текст можно не читать
+METHODIC_PAGE_KEYWORDS = re.compile(r'оформлени|структур|шрифт|интервал|пол[яей]\b', re.IGNORECASE)
+# Строка оглавления: название раздела, отточие и номер страницы
+PDF_TOC_LINE = re.compile(r'^(.{3,}?)[\s.…·_]{2,}(\d{1,4})$')
+METHODIC_FIELD_ANCHORS = {
+    'university_name': re.compile(r'университет|институт|академи', re.IGNORECASE),
+    'university_address': re.compile(r'\b\d{6}\b|адрес|\bг\.\s*[А-ЯЁ]'),
+    'faculty': re.compile(r'факультет', re.IGNORECASE),
+    'department': re.compile(r'кафедр', re.IGNORECASE),
+    'work_structure': re.compile(r'введени[ея][^.!?]{0,200}?(?:заключени|вывод)', re.IGNORECASE),
+    'font': re.compile(r'шрифт|times new roman|arial', re.IGNORECASE),
+    'line_spacing': re.compile(r'интервал|полуторн', re.IGNORECASE),
+    'margins': re.compile(r'пол[яей]\b|левое|правое', re.IGNORECASE)
+}
+
+HEADING_PATTERN = re.compile(r'^(?:введение|заключение|список литературы|глава\s+\d+\b.{0,150})$', re.IGNORECASE)
+
 # Создаем директории
 os.makedirs("методички", exist_ok=True)
 os.makedirs("работы", exist_ok=True)
@@ -117,6 +280,34 @@ class Database:
             )
         ''')
         
+        # Миграция: SHA-256 содержимого файла для повторных загрузок той же методички
+        cursor.execute('PRAGMA table_info(methodics)')
+        if 'content_hash' not in [column[1] for column in cursor.fetchall()]:
+            cursor.execute('ALTER TABLE methodics ADD COLUMN content_hash TEXT')
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_methodics_content_hash ON methodics (content_hash)')
+        
+        # Задачи фоновой обработки методичек: этап и состояние переживают перезапуск
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS methodic_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER,
+                chat_id INTEGER,
+                message_id INTEGER,
+                file_id TEXT,
+                filename TEXT,
+                file_extension TEXT,
+                file_path TEXT,
+                content_hash TEXT,
+                stage TEXT,
+                status TEXT DEFAULT 'queued',
+                attempts INTEGER DEFAULT 0,
+                methodic_id INTEGER,
+                error TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
         conn.commit()
         conn.close()
     
@@ -195,7 +386,7 @@ class Database:
         conn.commit()
         conn.close()
     
-    def add_methodic(self, filename, file_path, university_name, university_address, faculty, department, work_structure, formatting_style, user_id):
+    def add_methodic(self, filename, file_path, university_name, university_address, faculty, department, work_structure, formatting_style, user_id, content_hash=None):
         conn = sqlite3.connect(self.db_path)
         cursor = conn.cursor()
         
@@ -219,16 +410,22 @@ class Database:
             }, ensure_ascii=False)
             
             cursor.execute('''
-                INSERT INTO methodics (filename, file_path, university_name, university_address, faculty, department, work_structure, formatting_style, uploaded_by)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                INSERT INTO methodics (filename, file_path, university_name, university_address, faculty, department, work_structure, formatting_style, uploaded_by, content_hash)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (filename, file_path, university_name, university_address, faculty, department, 
                   work_structure_json, 
                   formatting_style_json, 
-                  user_id))
+                  user_id,
+                  content_hash))
             methodic_id = cursor.lastrowid
             conn.commit()
             conn.close()
             return methodic_id
+        except sqlite3.IntegrityError:
+            # Тот же файл успели сохранить параллельно
+            conn.close()
+            existing = self.get_methodic_by_hash(content_hash)
+            return existing[0] if existing else None
         except Exception as e:
             logger.error(f"Error saving methodic to database: {e}")
             conn.rollback()
@@ -250,248 +447,1049 @@ class Database:
         result = cursor.fetchone()
         conn.close()
         return result
+    
+    def add_methodic_job(self, user_id, chat_id, message_id, file_id, filename, file_extension):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO methodic_jobs (user_id, chat_id, message_id, file_id, filename, file_extension)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (user_id, chat_id, message_id, file_id, filename, file_extension))
+        job_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        return job_id
+    
+    def update_methodic_job(self, job_id, **fields):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        columns = ', '.join(f"{name} = ?" for name in fields)
+        cursor.execute(
+            f'UPDATE methodic_jobs SET {columns}, updated_at = CURRENT_TIMESTAMP WHERE id = ?',
+            (*fields.values(), job_id)
+        )
+        conn.commit()
+        conn.close()
+    
+    def get_methodic_job(self, job_id):
+        conn = sqlite3.connect(self.db_path)
+        conn.row_factory = sqlite3.Row
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM methodic_jobs WHERE id = ?', (job_id,))
+        result = cursor.fetchone()
+        conn.close()
+        return dict(result) if result else None
+    
+    def get_unfinished_methodic_jobs(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute("SELECT id FROM methodic_jobs WHERE status IN ('queued', 'running') ORDER BY id")
+        job_ids = [row[0] for row in cursor.fetchall()]
+        conn.close()
+        return job_ids
+    
+    def get_methodic_by_hash(self, content_hash):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('SELECT * FROM methodics WHERE content_hash = ?', (content_hash,))
+        result = cursor.fetchone()
+        conn.close()
+        return result
 
-class DocumentProcessor:
-    def extract_text_from_pdf(self, file_path):
-        try:
-            with open(file_path, 'rb') as file:
-                reader = PyPDF2.PdfReader(file)
-                text = ""
-                for page in reader.pages:
-                    page_text = page.extract_text()
-                    if page_text:
-                        text += page_text + "\n"
-                return text.strip()
-        except Exception as e:
-            logger.error(f"PDF extraction error: {e}")
-            return ""
+class LLMResponseCache:
+    """Кэш ответов модели в SQLite с вытеснением по сроку жизни и общему объему.
     
-    def extract_text_from_docx(self, file_path):
-        try:
-            text = docx2txt.process(file_path)
-            return text.strip() if text else ""
-        except Exception as e:
-            logger.error(f"DOCX extraction error: {e}")
-            return ""
+    Ключ - хэш модели, температуры и нормализованных системного и
+    пользовательского промптов. Общий объем ведется в памяти, поэтому таблица
+    пересчитывается только при вытеснении. Методы вызываются из потоков.
+    """
+    def __init__(self, db_path=LLM_CACHE_PATH, ttl_hours=LLM_CACHE_TTL_HOURS, max_mb=LLM_CACHE_MAX_MB):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self.init_db()
     
-    async def extract_text_from_txt(self, file_path):
-        try:
-            async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
-                return await file.read()
-        except Exception as e:
-            logger.error(f"TXT extraction error: {e}")
-            return ""
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS llm_responses (
+                cache_key TEXT PRIMARY KEY,
+                content TEXT,
+                size INTEGER,
+                created_at REAL,
+                last_access REAL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_llm_responses_access ON llm_responses (last_access)')
+        conn.commit()
+        cursor.execute('SELECT COALESCE(SUM(size), 0) FROM llm_responses')
+        self.total_size = cursor.fetchone()[0]
+        conn.close()
     
-    async def process_methodic(self, file_path):
-        file_extension = file_path.lower().split('.')[-1]
-        text = ""
-        
-        if file_extension == 'pdf':
-            text = self.extract_text_from_pdf(file_path)
-        elif file_extension == 'docx':
-            text = self.extract_text_from_docx(file_path)
-        elif file_extension == 'txt':
-            text = await self.extract_text_from_txt(file_path)
-        else:
+    @staticmethod
+    def make_key(model, temperature, system_prompt, user_prompt):
+        normalize = lambda prompt: ' '.join(prompt.split())
+        payload = json.dumps([model, temperature, normalize(system_prompt), normalize(user_prompt)], ensure_ascii=False)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def get(self, cache_key):
+        now = datetime.now().timestamp()
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute('SELECT content, created_at FROM llm_responses WHERE cache_key = ?', (cache_key,))
+            row = cursor.fetchone()
+            if row and now - row[1] <= self.ttl_seconds:
+                cursor.execute('UPDATE llm_responses SET last_access = ? WHERE cache_key = ?', (now, cache_key))
+                conn.commit()
+                self.hits += 1
+                return row[0]
+            if row:
+                cursor.execute('DELETE FROM llm_responses WHERE cache_key = ?', (cache_key,))
+                conn.commit()
+            self.misses += 1
             return None
-        
-        if not text:
+        except sqlite3.Error as e:
+            logger.error(f"LLM cache read error: {e}")
+            self.misses += 1
             return None
-        
-        return self.extract_methodic_info(text)
+        finally:
+            conn.close()
     
-    def extract_methodic_info(self, text):
+    def set(self, cache_key, content):
+        now = datetime.now().timestamp()
+        size = len(content.encode('utf-8'))
+        with self._lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            try:
+                cursor.execute('SELECT size FROM llm_responses WHERE cache_key = ?', (cache_key,))
+                row = cursor.fetchone()
+                cursor.execute('''
+                    INSERT OR REPLACE INTO llm_responses (cache_key, content, size, created_at, last_access)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', (cache_key, content, size, now, now))
+                total_size = self.total_size + size - (row[0] if row else 0)
+                if total_size > self.max_bytes:
+                    total_size = self._evict(cursor, now)
+                conn.commit()
+                self.total_size = total_size
+            except sqlite3.Error as e:
+                logger.error(f"LLM cache write error: {e}")
+                conn.rollback()
+            finally:
+                conn.close()
+    
+    def _evict(self, cursor, now):
+        """Удаляет просроченные, затем давно не читанные записи; возвращает новый общий объем."""
+        cursor.execute('DELETE FROM llm_responses WHERE created_at < ?', (now - self.ttl_seconds,))
+        cursor.execute('SELECT COALESCE(SUM(size), 0) FROM llm_responses')
+        total_size = cursor.fetchone()[0]
+        if total_size <= self.max_bytes:
+            return total_size
+        cursor.execute('SELECT cache_key, size FROM llm_responses ORDER BY last_access')
+        stale_keys = []
+        for cache_key, size in cursor.fetchall():
+            if total_size <= self.max_bytes:
+                break
+            stale_keys.append((cache_key,))
+            total_size -= size
+        cursor.executemany('DELETE FROM llm_responses WHERE cache_key = ?', stale_keys)
+        return total_size
+    
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+class PageCache:
+    """Кэш извлеченного текста страниц в SQLite (zlib) с валидаторами HTTP.
+    
+    Запись свежа в течение ttl; после этого она перепроверяется условным GET
+    по ETag/Last-Modified и при ответе 304 продлевается без загрузки и разбора
+    страницы. При превышении общего объема удаляются устаревшие записи без
+    валидаторов, затем остальные в порядке последнего обращения. Общий объем
+    ведется в памяти, поэтому запись не сканирует таблицу. Методы вызываются
+    из потоков.
+    """
+    def __init__(self, db_path=PAGE_CACHE_PATH, ttl_hours=PAGE_CACHE_TTL_HOURS, max_mb=PAGE_CACHE_MAX_MB):
+        self.db_path = db_path
+        self.ttl_seconds = ttl_hours * 3600
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+        self._lock = Lock()
+        self.init_db()
+    
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS pages (
+                url TEXT PRIMARY KEY,
+                text BLOB,
+                etag TEXT,
+                last_modified TEXT,
+                size INTEGER,
+                fetched_at REAL,
+                last_access REAL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_pages_access ON pages (last_access)')
+        conn.commit()
+        cursor.execute('SELECT COALESCE(SUM(size), 0) FROM pages')
+        self.total_size = cursor.fetchone()[0]
+        conn.close()
+    
+    def get(self, url):
+        """Запись {'text', 'etag', 'last_modified', 'fresh'} или None."""
+        now = datetime.now().timestamp()
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
         try:
-            university_info = self._extract_university_info(text)
-            work_structure = self._extract_work_structure(text)
-            formatting_style = self._extract_formatting_style(text)
-            
-            if not university_info:
-                university_info = {
-                    'university_name': "Федеральное государственное автономное образовательное учреждение высшего образования",
-                    'university_address': "г. Москва, ул. Примерная, д. 123",
-                    'faculty': "Факультет информационных технологий",
-                    'department': "Кафедра информатики и вычислительной техники"
-                }
-            
-            if not work_structure:
-                work_structure = {
-                    'required_sections': ['Введение', 'Основная часть', 'Заключение', 'Список литературы'],
-                    'chapter_count': 3,
-                    'has_introduction': True,
-                    'has_conclusion': True,
-                    'has_bibliography': True
-                }
-            
-            if not formatting_style:
-                formatting_style = {
-                    'font_family': 'Times New Roman',
-                    'font_size': '14',
-                    'line_spacing': '1.5',
-                    'margin_left': '3',
-                    'margin_right': '1',
-                    'margin_top': '2',
-                    'margin_bottom': '2'
-                }
-            
-            return {
-                'university': university_info,
-                'work_structure': work_structure,
-                'formatting_style': formatting_style,
-                'full_text': text[:4000]
-            }
-        except Exception as e:
-            logger.error(f"Methodic info extraction error: {e}")
+            cursor.execute('SELECT text, etag, last_modified, fetched_at FROM pages WHERE url = ?', (url,))
+            row = cursor.fetchone()
+            if not row:
+                self.misses += 1
+                return None
+            cursor.execute('UPDATE pages SET last_access = ? WHERE url = ?', (now, url))
+            conn.commit()
+            fresh = now - row[3] <= self.ttl_seconds
+            if fresh:
+                self.hits += 1
             return {
-                'university': {
-                    'university_name': "Федеральное государственное автономное образовательное учреждение высшего образования",
-                    'university_address': "г. Москва, ул. Примерная, д. 123",
-                    'faculty': "Факультет информационных технологий",
-                    'department': "Кафедра информатики и вычислительной техники"
-                },
-                'work_structure': {
-                    'required_sections': ['Введение', 'Основная часть', 'Заключение', 'Список литературы'],
-                    'chapter_count': 3,
-                    'has_introduction': True,
-                    'has_conclusion': True,
-                    'has_bibliography': True
-                },
-                'formatting_style': {
-                    'font_family': 'Times New Roman',
-                    'font_size': '14',
-                    'line_spacing': '1.5',
-                    'margin_left': '3',
-                    'margin_right': '1',
-                    'margin_top': '2',
-                    'margin_bottom': '2'
-                },
-                'full_text': text[:2000] if text else ""
+                'text': zlib.decompress(row[0]).decode('utf-8'),
+                'etag': row[1],
+                'last_modified': row[2],
+                'fresh': fresh
             }
+        except (sqlite3.Error, zlib.error) as e:
+            logger.error(f"Page cache read error: {e}")
+            self.misses += 1
+            return None
+        finally:
+            conn.close()
     
-    def _extract_university_info(self, text):
-        patterns = {
-            'university_name': [
-                r'(?:ФГБОУ ВО|ФГАОУ ВО|ФГБОУ|ГОУ ВПО|Федеральное|Государственное)[^.!?]{0,200}?(?:университет|институт|академия|college|university)',
-                r'[А-Я][А-Яа-яё\s\-]{5,}?(?:университет|институт|академия)[^.!?]{0,100}',
-                r'МИНИСТЕРСТВО[^.!?]{0,150}?(?:университет|институт|академия)',
-                r'НАЦИОНАЛЬНЫЙ[^.!?]{0,100}?(?:университет|институт|академия)'
-            ],
-            'university_address': [
-                r'(?:адрес|address)[:\s]+([^.!?\n]{20,100})',
-                r'[0-9]{6}[,\s]+(?:г\.|город|city)[\s]+([А-Я][а-яё\s\-]+)',
-                r'(?:г\.|город)[\s]+([А-Я][а-яё]+)[^.!?]{0,50}?(?:ул\.|улица|проспект|пр\.)',
-                r'[А-Я][а-яё\s\-]{5,}?(?:область|край)[^.!?]{0,50}?(?:г\.|город)[\s]+([А-Я][а-яё]+)'
-            ],
-            'faculty': [
-                r'(?:факультет|faculty)[\s]+([^.!?\n]{10,80})',
-                r'[А-Я][А-Яа-яё\s\-]{5,}?(?:факультет|институт)[^.!?]{0,50}',
-                r'(?:институт)[^.!?]{0,50}?([А-Я][А-Яа-яё\s\-]{5,}?(?:информатики|экономики|юриспруденции))'
-            ],
-            'department': [
-                r'(?:кафедра|department)[\s]+([^.!?\n]{10,80})',
-                r'[А-Я][А-Яа-яё\s\-]{5,}?(?:кафедра)[^.!?]{0,50}',
-                r'(?:кафедра)[^.!?]{0,50}?([А-Я][А-Яа-яё\s\-]{5,}?(?:информатики|математики|физики))'
-            ]
-        }
-        
-        university_info = {}
-        for key, pattern_list in patterns.items():
-            for pattern in pattern_list:
-                matches = re.findall(pattern, text, re.IGNORECASE | re.MULTILINE)
-                if matches:
-                    university_info[key] = matches[0].strip()
-                    break
-        
-        if not university_info.get('university_name'):
-            university_info['university_name'] = "Федеральное государственное автономное образовательное учреждение высшего образования"
-        if not university_info.get('university_address'):
-            university_info['university_address'] = "г. Москва, ул. Примерная, д. 123"
-        if not university_info.get('faculty'):
-            university_info['faculty'] = "Факультет информационных технологий"
-        if not university_info.get('department'):
-            university_info['department'] = "Кафедра информатики и вычислительной техники"
-        
-        return university_info
+    def set(self, url, text, etag=None, last_modified=None):
+        now = datetime.now().timestamp()
+        data = zlib.compress(text.encode('utf-8'))
+        with self._lock:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            try:
+                cursor.execute('SELECT size FROM pages WHERE url = ?', (url,))
+                row = cursor.fetchone()
+                cursor.execute('''
+                    INSERT OR REPLACE INTO pages (url, text, etag, last_modified, size, fetched_at, last_access)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', (url, data, etag, last_modified, len(data), now, now))
+                total_size = self.total_size + len(data) - (row[0] if row else 0)
+                if total_size > self.max_bytes:
+                    total_size = self._evict(cursor, now)
+                conn.commit()
+                self.total_size = total_size
+            except sqlite3.Error as e:
+                logger.error(f"Page cache write error: {e}")
+                conn.rollback()
+            finally:
+                conn.close()
     
-    def _extract_work_structure(self, text):
-        structure_patterns = [
-            r'(?:структура|содержание|оглавление)[^.!?]{0,200}?(?:введение|введени[ея])[^.!?]{0,200}?(?:глава|раздел|часть)[^.!?]{0,200}?(?:заключение|выводы)',
-            r'(?:должна содержать|включает|состоит из)[^.!?]{0,300}',
-            r'(?:введение|введени[ея])[^.!?]{0,100}?(?:основная часть|главы|разделы)[^.!?]{0,100}?(?:заключение|выводы)',
-            r'(?:глава\s+\d+[^.!?]{0,50}){2,}',
-            r'(?:раздел\s+\d+[^.!?]{0,50}){2,}'
-        ]
-        
-        work_structure = {
-            'required_sections': [],
-            'chapter_count': 3,
-            'has_introduction': True,
-            'has_conclusion': True,
-            'has_bibliography': True
-        }
-        
-        for pattern in structure_patterns:
-            matches = re.findall(pattern, text, re.IGNORECASE | re.MULTILINE)
-            if matches:
-                structure_text = matches[0]
-                
-                chapter_matches = re.findall(r'(глава|раздел)\s*(\d+)', structure_text, re.IGNORECASE)
-                if chapter_matches:
-                    work_structure['chapter_count'] = len(chapter_matches)
-                
-                if 'введение' in structure_text.lower():
-                    work_structure['required_sections'].append('Введение')
-                if 'заключение' in structure_text.lower() or 'выводы' in structure_text.lower():
-                    work_structure['required_sections'].append('Заключение')
-                if 'литератур' in structure_text.lower() or 'библиограф' in structure_text.lower():
-                    work_structure['required_sections'].append('Список литературы')
-                if 'приложен' in structure_text.lower():
-                    work_structure['required_sections'].append('Приложения')
-                
-                break
-        
-        if not work_structure['required_sections']:
-            work_structure['required_sections'] = ['Введение', 'Основная часть', 'Заключение', 'Список литературы']
-        
-        return work_structure
+    def touch(self, url):
+        """Продлевает запись после ответа 304 Not Modified."""
+        now = datetime.now().timestamp()
+        conn = sqlite3.connect(self.db_path)
+        try:
+            conn.execute('UPDATE pages SET fetched_at = ?, last_access = ? WHERE url = ?', (now, now, url))
+            conn.commit()
+            self.revalidated += 1
+        except sqlite3.Error as e:
+            logger.error(f"Page cache write error: {e}")
+        finally:
+            conn.close()
     
-    def _extract_formatting_style(self, text):
-        formatting_patterns = {
-            'font_family': [
+    def _evict(self, cursor, now):
+        """Удаляет устаревшие записи без валидаторов, затем давно не читанные; возвращает новый общий объем."""
+        cursor.execute(
+            'DELETE FROM pages WHERE fetched_at < ? AND etag IS NULL AND last_modified IS NULL',
+            (now - self.ttl_seconds,)
+        )
+        cursor.execute('SELECT COALESCE(SUM(size), 0) FROM pages')
+        total_size = cursor.fetchone()[0]
+        if total_size <= self.max_bytes:
+            return total_size
+        cursor.execute('SELECT url, size FROM pages ORDER BY last_access')
+        stale_urls = []
+        for url, size in cursor.fetchall():
+            if total_size <= self.max_bytes:
+                break
+            stale_urls.append((url,))
+            total_size -= size
+        cursor.executemany('DELETE FROM pages WHERE url = ?', stale_urls)
+        return total_size
+    
+    def stats(self):
+        total = self.hits + self.revalidated + self.misses
+        return {
+            'hits': self.hits,
+            'revalidated': self.revalidated,
+            'misses': self.misses,
+            'hit_rate': (self.hits + self.revalidated) / total if total else 0.0
+        }
+
+class SourceIndex:
+    """Локальный полнотекстовый индекс источников в SQLite FTS5 с ранжированием BM25.
+    
+    Индексируются леммы текста, поэтому запрос находит любые словоформы.
+    Уже посчитанные леммы можно передать в add(), чтобы не нормализовать текст повторно.
+    Загруженные страницы добавляются целиком, методички - фрагментами по
+    SOURCE_INDEX_PASSAGE символов.
+    """
+    def __init__(self, normalizer, db_path=SOURCE_INDEX_PATH):
+        self.normalizer = normalizer
+        self.db_path = db_path
+        self.init_db()
+    
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS sources USING fts5(
+                lemmas,
+                url UNINDEXED,
+                kind UNINDEXED,
+                content UNINDEXED
+            )
+        ''')
+        conn.commit()
+        conn.close()
+    
+    def add(self, url, text, kind='web', lemmas=None):
+        self._replace(url, [(url, text, lemmas)], kind)
+    
+    def add_document(self, name, text, kind='methodic'):
+        passages = self._split_passages(text)
+        self._replace(name, [(f"{name}#{i}", passage, None) for i, passage in enumerate(passages)], kind)
+    
+    def _replace(self, name, documents, kind):
+        rows = [
+            (' '.join(lemmas if lemmas is not None else self.normalizer.normalize(text)), url, kind, text)
+            for url, text, lemmas in documents
+        ]
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        try:
+            prefix = f"{name}#"
+            cursor.execute('DELETE FROM sources WHERE url = ? OR substr(url, 1, ?) = ?', (name, len(prefix), prefix))
+            cursor.executemany('INSERT INTO sources (lemmas, url, kind, content) VALUES (?, ?, ?, ?)', rows)
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Source index write error: {e}")
+            conn.rollback()
+        finally:
+            conn.close()
+    
+    @staticmethod
+    def _split_passages(text, size=SOURCE_INDEX_PASSAGE):
+        passages = []
+        current = []
+        length = 0
+        for paragraph in re.split(r'\n\s*\n|\n', text):
+            paragraph = ' '.join(paragraph.split())
+            if not paragraph:
+                continue
+            if current and length + len(paragraph) > size:
+                passages.append(' '.join(current))
+                current, length = [], 0
+            current.append(paragraph)
+            length += len(paragraph) + 1
+        if current:
+            passages.append(' '.join(current))
+        return [passage[:size * 2] for passage in passages]
+    
+    def search(self, lemmas, limit=20):
+        """Документы, содержащие хотя бы одну из лемм, по убыванию BM25.
+        
+        Возвращает словари с ключами url, kind, content и lemmas (множество
+        лемм документа, чтобы не нормализовать текст повторно).
+        """
+        terms = sorted({lemma for lemma in lemmas if len(lemma) > 2})
+        if not terms:
+            return []
+        query = ' OR '.join(f'"{term}"' for term in terms)
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        try:
+            cursor.execute(
+                'SELECT url, kind, content, lemmas FROM sources WHERE sources MATCH ? ORDER BY bm25(sources), url LIMIT ?',
+                (query, limit)
+            )
+            return [
+                {'url': url, 'kind': kind, 'content': content, 'lemmas': set(lemma_text.split())}
+                for url, kind, content, lemma_text in cursor.fetchall()
+            ]
+        except sqlite3.Error as e:
+            logger.error(f"Source index read error: {e}")
+            return []
+        finally:
+            conn.close()
+
+class GrammarCache:
+    """Кэш исправленных предложений: LRU в памяти и таблица SQLite на диске.
+    
+    Ключ - SHA-256 имени модели, параметров генерации и текста предложения,
+    поэтому смена модели или параметров автоматически делает старые записи
+    недоступными. Методы потокобезопасны: кэш используется из пула CPU.
+    """
+    def __init__(self, model_name, params, db_path=GRAMMAR_CACHE_PATH,
+                 memory_size=GRAMMAR_CACHE_MEMORY, max_entries=GRAMMAR_CACHE_MAX_ENTRIES):
+        self.prefix = json.dumps([model_name, params], sort_keys=True)
+        self.db_path = db_path
+        self.memory_size = memory_size
+        self.max_entries = max_entries
+        self.memory = OrderedDict()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._lock = Lock()
+        self.init_db()
+    
+    def init_db(self):
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS grammar_corrections (
+                cache_key TEXT PRIMARY KEY,
+                corrected TEXT,
+                last_access REAL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_grammar_corrections_access ON grammar_corrections (last_access)')
+        conn.commit()
+        conn.close()
+    
+    def make_key(self, sentence):
+        return hashlib.sha256(f"{self.prefix}\n{sentence}".encode('utf-8')).hexdigest()
+    
+    def get_many(self, sentences):
+        """Возвращает словарь {предложение: исправление} для найденных в кэше."""
+        found = {}
+        disk_keys = {}
+        with self._lock:
+            for sentence in set(sentences):
+                cache_key = self.make_key(sentence)
+                if cache_key in self.memory:
+                    self.memory.move_to_end(cache_key)
+                    found[sentence] = self.memory[cache_key]
+                    self.memory_hits += 1
+                else:
+                    disk_keys[cache_key] = sentence
+        
+        if disk_keys:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            try:
+                keys = list(disk_keys)
+                rows = []
+                for start in range(0, len(keys), 500):
+                    chunk = keys[start:start + 500]
+                    cursor.execute(
+                        f"SELECT cache_key, corrected FROM grammar_corrections WHERE cache_key IN ({','.join('?' * len(chunk))})",
+                        chunk
+                    )
+                    rows.extend(cursor.fetchall())
+                now = datetime.now().timestamp()
+                cursor.executemany('UPDATE grammar_corrections SET last_access = ? WHERE cache_key = ?',
+                                   [(now, cache_key) for cache_key, _ in rows])
+                conn.commit()
+            except sqlite3.Error as e:
+                logger.error(f"Grammar cache read error: {e}")
+                rows = []
+            finally:
+                conn.close()
+            
+            with self._lock:
+                for cache_key, corrected in rows:
+                    found[disk_keys[cache_key]] = corrected
+                    self._remember(cache_key, corrected)
+                self.disk_hits += len(rows)
+                self.misses += len(disk_keys) - len(rows)
+        
+        return found
+    
+    def set_many(self, corrections):
+        """Сохраняет пары (предложение, исправление) в обоих уровнях кэша."""
+        if not corrections:
+            return
+        now = datetime.now().timestamp()
+        rows = [(self.make_key(sentence), corrected, now) for sentence, corrected in corrections]
+        with self._lock:
+            for cache_key, corrected, _ in rows:
+                self._remember(cache_key, corrected)
+        
+        conn = sqlite3.connect(self.db_path)
+        cursor = conn.cursor()
+        try:
+            cursor.executemany('''
+                INSERT OR REPLACE INTO grammar_corrections (cache_key, corrected, last_access)
+                VALUES (?, ?, ?)
+            ''', rows)
+            cursor.execute('SELECT COUNT(*) FROM grammar_corrections')
+            overflow = cursor.fetchone()[0] - self.max_entries
+            if overflow > 0:
+                # Удаляем с запасом, чтобы не чистить таблицу на каждой записи
+                cursor.execute('''
+                    DELETE FROM grammar_corrections WHERE cache_key IN (
+                        SELECT cache_key FROM grammar_corrections ORDER BY last_access LIMIT ?
+                    )
+                ''', (overflow + self.max_entries // 10,))
+            conn.commit()
+        except sqlite3.Error as e:
+            logger.error(f"Grammar cache write error: {e}")
+            conn.rollback()
+        finally:
+            conn.close()
+    
+    def _remember(self, cache_key, corrected):
+        self.memory[cache_key] = corrected
+        self.memory.move_to_end(cache_key)
+        while len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+    
+    def stats(self):
+        total = self.memory_hits + self.disk_hits + self.misses
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'hit_rate': (self.memory_hits + self.disk_hits) / total if total else 0.0,
+            'memory_entries': len(self.memory)
+        }
+
+class HashingWriter:
+    """Файл для записи, который по ходу записи считает SHA-256 содержимого."""
+    def __init__(self, file):
+        self.file = file
+        self.sha256 = hashlib.sha256()
+    
+    def write(self, data):
+        self.sha256.update(data)
+        return self.file.write(data)
+    
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+class MethodicFieldExtractor:
+    """Поиск полей методички по заранее скомпилированным шаблонам.
+    
+    Текст просматривается один раз общим выражением из ключевых слов полей;
+    шаблоны поля проверяются только в окнах вокруг первых max_anchors
+    вхождений каждого его ключевого слова (search, первое совпадение), поэтому шаблоны
+    с ленивыми повторами не перебирают весь документ. На документ отводится
+    budget_ms: по его исчерпании ненайденные поля остаются пустыми.
+    
+    extract() возвращает для каждого найденного поля то же, что первый элемент
+    re.findall: строку группы или кортеж групп.
+    """
+    UNIVERSITY_FLAGS = re.IGNORECASE | re.MULTILINE
+    
+    # Поле: (ключевые слова, символов до и после ключевого слова, шаблоны, флаги)
+    FIELDS = {
+        'university_name': (
+            ['университет', 'институт', 'академи', 'college', 'university'], 250, 150, [
+                r'(?:ФГБОУ ВО|ФГАОУ ВО|ФГБОУ|ГОУ ВПО|Федеральное|Государственное)[^.!?]{0,200}?(?:университет|институт|академия|college|university)',
+                r'[А-Я][А-Яа-яё\s\-]{5,}?(?:университет|институт|академия)[^.!?]{0,100}',
+                r'МИНИСТЕРСТВО[^.!?]{0,150}?(?:университет|институт|академия)',
+                r'НАЦИОНАЛЬНЫЙ[^.!?]{0,100}?(?:университет|институт|академия)'
+            ], UNIVERSITY_FLAGS
+        ),
+        'university_address': (
+            ['адрес', 'address', 'г.', 'город', 'city'], 150, 150, [
+                r'(?:адрес|address)[:\s]+([^.!?\n]{20,100})',
+                r'[0-9]{6}[,\s]+(?:г\.|город|city)[\s]+([А-Я][а-яё\s\-]+)',
+                r'(?:г\.|город)[\s]+([А-Я][а-яё]+)[^.!?]{0,50}?(?:ул\.|улица|проспект|пр\.)',
+                r'[А-Я][а-яё\s\-]{5,}?(?:область|край)[^.!?]{0,50}?(?:г\.|город)[\s]+([А-Я][а-яё]+)'
+            ], UNIVERSITY_FLAGS
+        ),
+        'faculty': (
+            ['факультет', 'faculty', 'институт'], 150, 150, [
+                r'(?:факультет|faculty)[\s]+([^.!?\n]{10,80})',
+                r'[А-Я][А-Яа-яё\s\-]{5,}?(?:факультет|институт)[^.!?]{0,50}',
+                r'(?:институт)[^.!?]{0,50}?([А-Я][А-Яа-яё\s\-]{5,}?(?:информатики|экономики|юриспруденции))'
+            ], UNIVERSITY_FLAGS
+        ),
+        'department': (
+            ['кафедр', 'department'], 150, 150, [
+                r'(?:кафедра|department)[\s]+([^.!?\n]{10,80})',
+                r'[А-Я][А-Яа-яё\s\-]{5,}?(?:кафедра)[^.!?]{0,50}',
+                r'(?:кафедра)[^.!?]{0,50}?([А-Я][А-Яа-яё\s\-]{5,}?(?:информатики|математики|физики))'
+            ], UNIVERSITY_FLAGS
+        ),
+        'work_structure': (
+            ['структур', 'содержани', 'оглавлени', 'должна содержать', 'включает', 'состоит из', 'введени',
+             'глава', 'раздел'], 0, 700, [
+                r'(?:структура|содержание|оглавление)[^.!?]{0,200}?(?:введение|введени[ея])[^.!?]{0,200}?(?:глава|раздел|часть)[^.!?]{0,200}?(?:заключение|выводы)',
+                r'(?:должна содержать|включает|состоит из)[^.!?]{0,300}',
+                r'(?:введение|введени[ея])[^.!?]{0,100}?(?:основная часть|главы|разделы)[^.!?]{0,100}?(?:заключение|выводы)',
+                r'(?:глава\s+\d+[^.!?]{0,50}){2,}',
+                r'(?:раздел\s+\d+[^.!?]{0,50}){2,}'
+            ], UNIVERSITY_FLAGS
+        ),
+        'font_family': (
+            ['шрифт', 'times new roman', 'arial', 'helvetica'], 0, 60, [
                 r'шрифт[:\s]*([^\n,\d]{3,30})',
                 r'([Tt]imes [Nn]ew [Rr]oman|[Aa]rial|[Hh]elvetica)'
-            ],
-            'font_size': [
+            ], re.IGNORECASE
+        ),
+        'font_size': (
+            ['шрифт', 'размер', 'pt', 'пт'], 20, 60, [
                 r'шрифт[:\s]*(\d+)',
                 r'размер[:\s]*шрифта[:\s]*(\d+)',
                 r'(\d+)[\s]*(?:pt|пт)'
-            ],
-            'line_spacing': [
+            ], re.IGNORECASE
+        ),
+        'line_spacing': (
+            ['интервал', 'междустрочн', 'полуторный', 'одинарный', 'двойной'], 20, 200, [
                 r'интервал[:\s]*([^\n]+)',
                 r'([\d\.]+)[\s]*(?:междустрочн|интервал)',
                 r'(полуторный|одинарный|двойной)'
-            ],
-            'margins': [
+            ], re.IGNORECASE
+        ),
+        'margins': (
+            ['поля', 'левое', 'верхнее'], 0, 100, [
                 r'поля[:\s]*([^\n]{10,50})',
                 r'левое[:\s]*(\d+)[^.!?]{0,20}?правое[:\s]*(\d+)',
                 r'верхнее[:\s]*(\d+)[^.!?]{0,20}?нижнее[:\s]*(\d+)'
+            ], re.IGNORECASE
+        )
+    }
+    
+    def __init__(self, budget_ms=METHODIC_EXTRACT_BUDGET_MS, max_anchors=METHODIC_MAX_ANCHORS):
+        self.budget = budget_ms / 1000
+        self.max_anchors = max_anchors
+        self.fields = {}
+        keyword_fields = {}
+        for name, (keywords, before, after, patterns, flags) in self.FIELDS.items():
+            self.fields[name] = (before, after, [re.compile(pattern, flags) for pattern in patterns])
+            for keyword in keywords:
+                keyword_fields.setdefault(keyword, []).append(name)
+        # Одно ключевое слово может относиться к нескольким полям. Поиск идет по
+        # тексту в нижнем регистре: чередование без групп и IGNORECASE в разы быстрее
+        self.keyword_fields = keyword_fields
+        alternation = '|'.join(re.escape(keyword) for keyword in sorted(keyword_fields, key=len, reverse=True))
+        self.anchor_pattern = re.compile(alternation)
+        self.anchor_pattern_ignorecase = re.compile(alternation, re.IGNORECASE)
+    
+    def extract(self, text, names=None):
+        names = list(names or self.fields)
+        deadline = time.perf_counter() + self.budget
+        anchors = self._find_anchors(text, names)
+        found = {}
+        for name in names:
+            before, after, patterns = self.fields[name]
+            windows = self._windows(text, anchors[name], before, after)
+            for pattern in patterns:
+                match = None
+                for start, end in windows:
+                    if time.perf_counter() > deadline:
+                        logger.warning(f"Methodic extraction budget exceeded, fields found: {list(found)}")
+                        return found
+                    match = pattern.search(text, start, end)
+                    if match:
+                        break
+                if match:
+                    groups = match.groups('')
+                    found[name] = match.group(0) if not groups else groups[0] if len(groups) == 1 else groups
+                    break
+        return found
+    
+    def _find_anchors(self, text, names):
+        """Позиции первых max_anchors вхождений каждого ключевого слова полей names."""
+        anchors = {name: [] for name in names}
+        counts = dict.fromkeys(
+            [keyword for keyword, fields in self.keyword_fields.items() if any(name in anchors for name in fields)], 0
+        )
+        pending = len(counts)
+        lowered = text.lower()
+        if len(lowered) == len(text):
+            matches = self.anchor_pattern.finditer(lowered)
+        else:
+            # Редкие символы меняют длину при lower(): позиции разошлись бы с текстом
+            matches = self.anchor_pattern_ignorecase.finditer(text)
+        for match in matches:
+            keyword = match.group().lower()
+            if keyword not in counts or counts[keyword] >= self.max_anchors:
+                continue
+            counts[keyword] += 1
+            if counts[keyword] == self.max_anchors:
+                pending -= 1
+            for name in self.keyword_fields[keyword]:
+                if name in anchors:
+                    anchors[name].append(match.start())
+            if not pending:
+                break
+        return anchors
+    
+    @staticmethod
+    def _windows(text, positions, before, after):
+        """Объединенные окна вокруг ключевых слов; начало окна не режет слово."""
+        windows = []
+        for position in positions:
+            start = max(0, position - before)
+            while start > 0 and text[start - 1].isalnum():
+                start -= 1
+            end = min(len(text), position + after)
+            if windows and start <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], max(windows[-1][1], end))
+            else:
+                windows.append((start, end))
+        return windows
+
+# Открытые PDF в процессе-обработчике: порции одного файла не разбирают его заново
+_pdf_readers = OrderedDict()
+
+def open_pdf(file_path):
+    key = (file_path, os.path.getmtime(file_path))
+    reader = _pdf_readers.get(key)
+    if reader is None:
+        reader = PyPDF2.PdfReader(file_path)
+        _pdf_readers[key] = reader
+        while len(_pdf_readers) > 2:
+            _pdf_readers.popitem(last=False)
+    return reader
+
+def _outline_pages(reader, outline):
+    """Номера страниц закладок, в названии которых есть METHODIC_PAGE_KEYWORDS."""
+    pages = []
+    for item in outline:
+        if isinstance(item, list):
+            pages.extend(_outline_pages(reader, item))
+        elif METHODIC_PAGE_KEYWORDS.search(getattr(item, 'title', '') or ''):
+            try:
+                pages.append(reader.get_destination_page_number(item))
+            except Exception:
+                continue
+    return pages
+
+def plan_pdf_pages(file_path, budget=PDF_PAGE_BUDGET, front_pages=PDF_FRONT_PAGES):
+    """Порядок чтения страниц PDF в пределах budget.
+    
+    Сначала титульные страницы, затем страницы с требованиями, найденные по
+    закладкам PDF и по строкам оглавления на титульных страницах ("Требования к
+    оформлению ..... 64"; печатный номер может быть смещен на страницу, поэтому
+    берутся обе соседние), затем остальные по порядку. Возвращает (число
+    страниц, [(номер, текст)] титульных страниц, приоритетные номера, порядок
+    остальных номеров).
+    """
+    reader = open_pdf(file_path)
+    page_count = len(reader.pages)
+    front = [(number, reader.pages[number].extract_text() or "") for number in range(min(front_pages, page_count, budget))]
+    
+    candidates = []
+    try:
+        candidates.extend(_outline_pages(reader, reader.outline))
+    except Exception as e:
+        logger.warning(f"PDF outline error: {e}")
+    for _, text in front:
+        for line in text.splitlines():
+            match = PDF_TOC_LINE.match(line.strip())
+            if match and METHODIC_PAGE_KEYWORDS.search(match.group(1)):
+                printed = int(match.group(2))
+                candidates.extend([printed - 1, printed])
+    
+    taken = {number for number, _ in front}
+    priority = []
+    for number in candidates:
+        if 0 <= number < page_count and number not in taken and len(taken) < budget:
+            taken.add(number)
+            priority.append(number)
+    rest = [number for number in range(page_count) if number not in taken][:max(0, budget - len(taken))]
+    return page_count, front, priority, rest
+
+def extract_pdf_pages(file_path, pages):
+    """[(номер, текст, есть_требования)] для страниц pages. Выполняется в процессе-обработчике."""
+    reader = open_pdf(file_path)
+    result = []
+    for number in pages:
+        text = reader.pages[number].extract_text() or ""
+        result.append((number, text, bool(METHODIC_PAGE_KEYWORDS.search(text))))
+    return result
+
+class DocumentProcessor:
+    UNIVERSITY_FIELDS = ['university_name', 'university_address', 'faculty', 'department']
+    FORMATTING_FIELDS = ['font_family', 'font_size', 'line_spacing', 'margins']
+    CHAPTER_PATTERN = re.compile(r'(глава|раздел)\s*(\d+)', re.IGNORECASE)
+    
+    def __init__(self, source_index=None):
+        self.source_index = source_index
+        self.pdf_executor = None
+        self.field_extractor = MethodicFieldExtractor()
+    
+    def _get_pdf_executor(self):
+        if self.pdf_executor is None:
+            self.pdf_executor = ProcessPoolExecutor(
+                max_workers=PDF_WORKERS, mp_context=multiprocessing.get_context('spawn')
+            )
+        return self.pdf_executor
+    
+    def close(self, wait=False):
+        if self.pdf_executor is not None:
+            self.pdf_executor.shutdown(wait=wait, cancel_futures=True)
+            self.pdf_executor = None
+    
+    async def store_upload(self, telegram_file, file_extension, directory="методички"):
+        """Сохраняет загруженный файл под именем <sha256>.<расширение>.
+        
+        Хэш считается, пока файл пишется на диск; одинаковые файлы занимают
+        одно место. Возвращает (путь, хэш).
+        """
+        with tempfile.NamedTemporaryFile(dir=directory, suffix='.part', delete=False) as file:
+            writer = HashingWriter(file)
+            try:
+                await telegram_file.download_to_memory(writer)
+            except Exception:
+                file.close()
+                os.remove(file.name)
+                raise
+        content_hash = writer.hexdigest()
+        file_path = os.path.join(directory, f"{content_hash}.{file_extension}")
+        os.replace(file.name, file_path)
+        return file_path, content_hash
+    
+    async def extract_text_from_pdf(self, file_path):
+        """Текст PDF-методички, извлекаемый порциями страниц в пуле процессов.
+        
+        Читается не больше PDF_PAGE_BUDGET страниц в порядке plan_pdf_pages:
+        титульные, страницы с требованиями по закладкам и оглавлению, затем
+        остальные. В тексте сначала идут титульные страницы и страницы с
+        требованиями (по плану или по ключевым словам), затем прочие в порядке
+        страниц. Как только на прочитанных страницах встретились ключевые слова
+        всех полей (METHODIC_FIELD_ANCHORS), оставшиеся порции отменяются.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+            executor = self._get_pdf_executor()
+            page_count, front, planned, rest = await loop.run_in_executor(executor, plan_pdf_pages, file_path)
+            order = planned + rest
+            futures = [
+                loop.run_in_executor(executor, extract_pdf_pages, file_path, order[start:start + PDF_CHUNK_PAGES])
+                for start in range(0, len(order), PDF_CHUNK_PAGES)
             ]
+            
+            planned = set(planned)
+            priority_pages = []
+            other_pages = []
+            missing = set(METHODIC_FIELD_ANCHORS)
+            
+            def add_pages(pages):
+                nonlocal missing
+                for number, page_text, priority in pages:
+                    (priority_pages if priority or number in planned else other_pages).append((number, page_text))
+                    missing = {name for name in missing if not METHODIC_FIELD_ANCHORS[name].search(page_text)}
+            
+            add_pages((number, page_text, True) for number, page_text in front)
+            try:
+                for future in futures:
+                    if not missing:
+                        break
+                    add_pages(await future)
+            finally:
+                for future in futures:
+                    future.cancel()
+            
+            priority_pages.sort()
+            other_pages.sort()
+            logger.info(
+                f"PDF {file_path}: {len(priority_pages) + len(other_pages)} pages read "
+                f"({len(priority_pages)} priority), {page_count} total"
+            )
+            return "\n".join(text for _, text in priority_pages + other_pages).strip()
+        except Exception as e:
+            logger.error(f"PDF extraction error: {e}")
+            return ""
+    
+    def extract_text_from_docx(self, file_path):
+        try:
+            text = docx2txt.process(file_path)
+            return text.strip() if text else ""
+        except Exception as e:
+            logger.error(f"DOCX extraction error: {e}")
+            return ""
+    
+    async def extract_text_from_txt(self, file_path):
+        try:
+            async with aiofiles.open(file_path, 'r', encoding='utf-8') as file:
+                return await file.read()
+        except Exception as e:
+            logger.error(f"TXT extraction error: {e}")
+            return ""
+    
+    async def extract_methodic_text(self, file_path):
+        """Текст методички по расширению файла; текст заодно попадает в индекс источников."""
+        file_extension = file_path.lower().split('.')[-1]
+        text = ""
+        
+        if file_extension == 'pdf':
+            text = await self.extract_text_from_pdf(file_path)
+        elif file_extension == 'docx':
+            text = await asyncio.to_thread(self.extract_text_from_docx, file_path)
+        elif file_extension == 'txt':
+            text = await self.extract_text_from_txt(file_path)
+        
+        if text and self.source_index:
+            name = f"methodic:{os.path.basename(file_path)}"
+            await asyncio.to_thread(self.source_index.add_document, name, text)
+        
+        return text
+    
+    async def process_methodic(self, file_path):
+        text = await self.extract_methodic_text(file_path)
+        if not text:
+            return None
+        return self.extract_methodic_info(text)
+    
+    def extract_methodic_info(self, text):
+        try:
+            found = self.field_extractor.extract(text)
+            university_info = self._extract_university_info(text, found)
+            work_structure = self._extract_work_structure(text, found)
+            formatting_style = self._extract_formatting_style(text, found)
+            
+            if not university_info:
+                university_info = {
+                    'university_name': "Федеральное государственное автономное образовательное учреждение высшего образования",
+                    'university_address': "г. Москва, ул. Примерная, д. 123",
+                    'faculty': "Факультет информационных технологий",
+                    'department': "Кафедра информатики и вычислительной техники"
+                }
+            
+            if not work_structure:
+                work_structure = {
+                    'required_sections': ['Введение', 'Основная часть', 'Заключение', 'Список литературы'],
+                    'chapter_count': 3,
+                    'has_introduction': True,
+                    'has_conclusion': True,
+                    'has_bibliography': True
+                }
+            
+            if not formatting_style:
+                formatting_style = {
+                    'font_family': 'Times New Roman',
+                    'font_size': '14',
+                    'line_spacing': '1.5',
+                    'margin_left': '3',
+                    'margin_right': '1',
+                    'margin_top': '2',
+                    'margin_bottom': '2'
+                }
+            
+            return {
+                'university': university_info,
+                'work_structure': work_structure,
+                'formatting_style': formatting_style,
+                'full_text': text[:4000]
+            }
+        except Exception as e:
+            logger.error(f"Methodic info extraction error: {e}")
+            return {
+                'university': {
+                    'university_name': "Федеральное государственное автономное образовательное учреждение высшего образования",
+                    'university_address': "г. Москва, ул. Примерная, д. 123",
+                    'faculty': "Факультет информационных технологий",
+                    'department': "Кафедра информатики и вычислительной техники"
+                },
+                'work_structure': {
+                    'required_sections': ['Введение', 'Основная часть', 'Заключение', 'Список литературы'],
+                    'chapter_count': 3,
+                    'has_introduction': True,
+                    'has_conclusion': True,
+                    'has_bibliography': True
+                },
+                'formatting_style': {
+                    'font_family': 'Times New Roman',
+                    'font_size': '14',
+                    'line_spacing': '1.5',
+                    'margin_left': '3',
+                    'margin_right': '1',
+                    'margin_top': '2',
+                    'margin_bottom': '2'
+                },
+                'full_text': text[:2000] if text else ""
+            }
+    
+    def _extract_university_info(self, text, found=None):
+        if found is None:
+            found = self.field_extractor.extract(text, self.UNIVERSITY_FIELDS)
+        
+        university_info = {key: found[key].strip() for key in self.UNIVERSITY_FIELDS if key in found}
+        
+        if not university_info.get('university_name'):
+            university_info['university_name'] = "Федеральное государственное автономное образовательное учреждение высшего образования"
+        if not university_info.get('university_address'):
+            university_info['university_address'] = "г. Москва, ул. Примерная, д. 123"
+        if not university_info.get('faculty'):
+            university_info['faculty'] = "Факультет информационных технологий"
+        if not university_info.get('department'):
+            university_info['department'] = "Кафедра информатики и вычислительной техники"
+        
+        return university_info
+    
+    def _extract_work_structure(self, text, found=None):
+        if found is None:
+            found = self.field_extractor.extract(text, ['work_structure'])
+        
+        work_structure = {
+            'required_sections': [],
+            'chapter_count': 3,
+            'has_introduction': True,
+            'has_conclusion': True,
+            'has_bibliography': True
         }
         
+        structure_text = found.get('work_structure')
+        if structure_text:
+            chapter_matches = self.CHAPTER_PATTERN.findall(structure_text)
+            if chapter_matches:
+                work_structure['chapter_count'] = len(chapter_matches)
+            
+            if 'введение' in structure_text.lower():
+                work_structure['required_sections'].append('Введение')
+            if 'заключение' in structure_text.lower() or 'выводы' in structure_text.lower():
+                work_structure['required_sections'].append('Заключение')
+            if 'литератур' in structure_text.lower() or 'библиограф' in structure_text.lower():
+                work_structure['required_sections'].append('Список литературы')
+            if 'приложен' in structure_text.lower():
+                work_structure['required_sections'].append('Приложения')
+        
+        if not work_structure['required_sections']:
+            work_structure['required_sections'] = ['Введение', 'Основная часть', 'Заключение', 'Список литературы']
+        
+        return work_structure
+    
+    def _extract_formatting_style(self, text, found=None):
+        if found is None:
+            found = self.field_extractor.extract(text, self.FORMATTING_FIELDS)
+        
         formatting_style = {}
-        for key, pattern_list in formatting_patterns.items():
-            for pattern in pattern_list:
-                matches = re.findall(pattern, text, re.IGNORECASE)
-                if matches:
-                    if key == 'margins' and len(matches[0]) == 2:
-                        formatting_style['margin_left'] = matches[0][0]
-                        formatting_style['margin_right'] = matches[0][1]
-                    elif key == 'margins' and len(matches[0]) == 2:
-                        formatting_style['margin_top'] = matches[0][0]
-                        formatting_style['margin_bottom'] = matches[0][1]
-                    else:
-                        formatting_style[key] = matches[0] if isinstance(matches[0], str) else matches[0][0]
-                    break
+        for key in self.FORMATTING_FIELDS:
+            if key not in found:
+                continue
+            value = found[key]
+            if key == 'margins' and len(value) == 2:
+                formatting_style['margin_left'] = value[0]
+                formatting_style['margin_right'] = value[1]
+            elif key == 'margins' and len(value) == 2:
+                formatting_style['margin_top'] = value[0]
+                formatting_style['margin_bottom'] = value[1]
+            else:
+                formatting_style[key] = value if isinstance(value, str) else value[0]
         
         if not formatting_style.get('font_family'):
             formatting_style['font_family'] = 'Times New Roman'
@@ -510,46 +1508,1300 @@ class DocumentProcessor:
         
         return formatting_style
 
-class EnhancedAcademicWriter:
+class DeepSeekError(Exception):
+    pass
+
+class DeepSeekTimeout(DeepSeekError):
+    pass
+
+class DeepSeekBadResponse(DeepSeekError):
+    """Ответ не удалось разобрать (битый JSON или нет choices): сбой сервиса, запрос повторяется."""
+    pass
+
+class DeepSeekUnavailable(DeepSeekError):
+    """Автомат отключения разомкнут: запросы не отправляются до истечения паузы."""
+    pass
+
+class TokenBucket:
+    """Корзина токенов: capacity единиц, пополняется со скоростью rate единиц в секунду."""
+    def __init__(self, capacity, rate):
+        self.capacity = capacity
+        self.rate = rate
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+    
+    async def acquire(self, amount=1):
+        # Запрос больше емкости ждет полной корзины, иначе он никогда бы не прошел
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+    
+    def adjust(self, delta):
+        """Корректирует баланс после запроса, когда известен фактический расход."""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens - delta)
+
+class CircuitBreaker:
+    def __init__(self, failure_threshold, reset_timeout):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+    
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+    
+    def before_call(self):
+        state = self.state
+        if state == "open":
+            raise DeepSeekUnavailable("DeepSeek circuit breaker is open")
+        if state == "half_open":
+            # Пропускаем один пробный запрос, остальные ждут его результата
+            self.opened_at = time.monotonic()
+    
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+    
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+class DeepSeekClient:
+    """Клиент DeepSeek с постоянным пулом соединений, повторами и ограничением нагрузки.
+    
+    Один экземпляр разделяется всеми задачами генерации, поэтому лимиты запросов
+    в секунду и токенов в минуту действуют глобально. api_url и transport можно
+    подменить локальным тестовым сервером.
+    """
+    RETRY_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+    
+    def __init__(self, api_key, api_url=DEEPSEEK_API_URL, model="deepseek-chat",
+                 max_retries=DEEPSEEK_MAX_RETRIES, requests_per_second=DEEPSEEK_REQUESTS_PER_SECOND,
+                 tokens_per_minute=DEEPSEEK_TOKENS_PER_MINUTE, timeout=180, transport=None):
+        self.api_key = api_key
+        self.api_url = api_url
+        self.model = model
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.transport = transport
+        self.request_limiter = TokenBucket(max(1.0, requests_per_second), requests_per_second)
+        self.token_limiter = TokenBucket(tokens_per_minute, tokens_per_minute / 60)
+        self.breaker = CircuitBreaker(DEEPSEEK_BREAKER_THRESHOLD, DEEPSEEK_BREAKER_RESET)
+        self.http_client = None
+    
+    def _get_http_client(self):
+        if self.http_client is None or self.http_client.is_closed:
+            self.http_client = httpx.AsyncClient(
+                timeout=httpx.Timeout(self.timeout, connect=10),
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=60),
+                headers={"Authorization": f"Bearer {self.api_key}"},
+                transport=self.transport
+            )
+        return self.http_client
+    
+    async def close(self):
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+    
+    async def complete(self, messages, max_tokens=8000, temperature=0.7, on_text=None):
+        """Возвращает текст ответа; при on_text ответ читается потоком (SSE).
+        
+        Повтор возможен только до получения первого фрагмента, чтобы on_text
+        не получил текст дважды.
+        """
+        data = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens
+        }
+        # Грубая оценка: ~3 символа на токен промпта и половина лимита ответа
+        estimated_tokens = sum(len(message['content']) for message in messages) // 3 + max_tokens // 2
+        
+        attempt = 0
+        while True:
+            self.breaker.before_call()
+            await self.request_limiter.acquire()
+            await self.token_limiter.acquire(estimated_tokens)
+            
+            received = []
+            try:
+                if on_text:
+                    content, used_tokens = await self._stream(data, on_text, received)
+                else:
+                    content, used_tokens = await self._post(data)
+            except (httpx.TimeoutException, httpx.TransportError, httpx.HTTPStatusError, DeepSeekBadResponse) as e:
+                retry_after = None
+                reason = type(e).__name__
+                if isinstance(e, httpx.HTTPStatusError):
+                    reason = f"HTTP {e.response.status_code}"
+                    if e.response.status_code not in self.RETRY_STATUSES:
+                        # Сервис доступен, ошибка в самом запросе: повтор не поможет
+                        self.breaker.record_success()
+                        raise DeepSeekError(f"DeepSeek API error {e.response.status_code}") from e
+                    retry_after = self._parse_retry_after(e.response.headers.get("Retry-After"))
+                
+                self.breaker.record_failure()
+                if received or attempt >= self.max_retries:
+                    if isinstance(e, httpx.TimeoutException):
+                        raise DeepSeekTimeout("DeepSeek API timeout") from e
+                    raise DeepSeekError(f"DeepSeek API request failed: {e}") from e
+                
+                if retry_after is not None:
+                    delay = min(retry_after, 60.0)
+                else:
+                    delay = random.uniform(0, min(30.0, 2 ** attempt))
+                attempt += 1
+                logger.warning(f"DeepSeek request failed ({reason}), retry {attempt}/{self.max_retries} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            
+            self.breaker.record_success()
+            if used_tokens:
+                self.token_limiter.adjust(used_tokens - estimated_tokens)
+            return content
+    
+    async def _post(self, data):
+        response = await self._get_http_client().post(self.api_url, json=data)
+        response.raise_for_status()
+        try:
+            result = response.json()
+            return result['choices'][0]['message']['content'], (result.get('usage') or {}).get('total_tokens')
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            raise DeepSeekBadResponse(f"Malformed DeepSeek response: {e!r}") from e
+    
+    async def _stream(self, data, on_text, received):
+        used_tokens = None
+        payload_data = {**data, "stream": True, "stream_options": {"include_usage": True}}
+        async with self._get_http_client().stream("POST", self.api_url, json=payload_data) as response:
+            if response.status_code >= 400:
+                await response.aread()
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                try:
+                    chunk = json.loads(payload)
+                    if chunk.get('usage'):
+                        used_tokens = chunk['usage'].get('total_tokens')
+                    choices = chunk.get('choices') or [{}]
+                    delta = (choices[0].get('delta') or {}).get('content')
+                except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+                    raise DeepSeekBadResponse(f"Malformed DeepSeek stream chunk: {e!r}") from e
+                if delta:
+                    received.append(delta)
+                    await on_text(delta)
+        return "".join(received), used_tokens
+    
+    @staticmethod
+    def _parse_retry_after(value):
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.now(retry_at.tzinfo)).total_seconds())
+        except (TypeError, ValueError):
+            return None
+
+def find_near_duplicates(embeddings, threshold=SEMANTIC_DEDUP_THRESHOLD, block_size=SEMANTIC_DEDUP_BLOCK):
+    """Маска предложений, которые стоит оставить: первое из группы близких по смыслу.
+    
+    embeddings - нормализованные векторы (n, d). Сходство считается блоками
+    матричным умножением: блок сравнивается со всеми ранее оставленными
+    предложениями одной операцией, а внутри блока - по строкам его матрицы
+    сходства, так что цикл Python линеен по n.
+    """
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    keep = np.ones(len(embeddings), dtype=bool)
+    for start in range(0, len(embeddings), block_size):
+        end = min(start + block_size, len(embeddings))
+        block = embeddings[start:end]
+        
+        previous = embeddings[:start][keep[:start]]
+        if len(previous):
+            keep[start:end] &= (block @ previous.T).max(axis=1) < threshold
+        
+        inner = block @ block.T
+        for j in range(1, end - start):
+            if keep[start + j] and np.any(inner[j, :j][keep[start:start + j]] >= threshold):
+                keep[start + j] = False
+    return keep
+
+class VectorStore:
+    """Постоянное хранилище векторов в float32-файле, читаемом через np.memmap.
+    
+    Векторы только дописываются в конец файла, ключи - в соседний текстовый
+    файл, так что добавление не переписывает хранилище. При повторном ключе
+    действует последняя запись. Векторы другой модели несравнимы, поэтому при
+    смене модели хранилище создается заново.
+    """
+    def __init__(self, path=SOURCE_VECTORS_PATH, model_name=SIMILARITY_MODEL_NAME):
+        self.model_name = model_name
+        self.vectors_path = os.path.join(path, 'vectors.f32')
+        self.keys_path = os.path.join(path, 'keys.txt')
+        self.meta_path = os.path.join(path, 'meta.json')
+        self.dim = None
+        self.count = 0
+        self.rows = {}
+        self._matrix = None
+        self._lock = Lock()
+        os.makedirs(path, exist_ok=True)
+        self._load()
+    
+    def _load(self):
+        meta = {}
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, encoding='utf-8') as f:
+                meta = json.load(f)
+        if meta.get('model') != self.model_name:
+            for file_path in (self.vectors_path, self.keys_path, self.meta_path):
+                if os.path.exists(file_path):
+                    os.remove(file_path)
+            return
+        
+        self.dim = meta['dim']
+        keys = []
+        if os.path.exists(self.keys_path):
+            with open(self.keys_path, encoding='utf-8') as f:
+                keys = [line.rstrip('\n') for line in f]
+        row_bytes = self.dim * 4
+        vectors_size = os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+        self.count = min(len(keys), vectors_size // row_bytes)
+        
+        # Обрезаем хвост, недописанный при аварийной остановке
+        if vectors_size != self.count * row_bytes:
+            with open(self.vectors_path, 'r+b') as f:
+                f.truncate(self.count * row_bytes)
+        if len(keys) != self.count:
+            with open(self.keys_path, 'w', encoding='utf-8') as f:
+                f.write(''.join(f"{key}\n" for key in keys[:self.count]))
+        self.rows = {key: row for row, key in enumerate(keys[:self.count])}
+    
+    def __contains__(self, key):
+        return key in self.rows
+    
+    def add(self, keys, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = vectors.shape[1]
+                with open(self.meta_path, 'w', encoding='utf-8') as f:
+                    json.dump({'model': self.model_name, 'dim': self.dim}, f)
+            with open(self.vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            with open(self.keys_path, 'a', encoding='utf-8') as f:
+                f.write(''.join(f"{key}\n" for key in keys))
+            for key in keys:
+                self.rows[key] = self.count
+                self.count += 1
+    
+    def scores(self, query, keys):
+        """Скалярные произведения query с векторами keys одной матричной операцией."""
+        with self._lock:
+            if self._matrix is None or len(self._matrix) != self.count:
+                self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self.count, self.dim))
+            matrix = self._matrix
+            rows = np.fromiter((self.rows[key] for key in keys), dtype=np.int64, count=len(keys))
+        return matrix[rows] @ np.asarray(query, dtype=np.float32)
+
+class SentenceStreamSplitter:
+    """Делит поступающий по частям текст на законченные предложения.
+    
+    feed() возвращает пары (предложение, конец_абзаца) для предложений, граница
+    которых уже получена; хвост без границы остается в буфере до flush().
+    """
+    BOUNDARY = re.compile(r'(?<=[.!?])\s+|\n\s*\n')
+    
     def __init__(self):
-        self.api_key = DEEPSEEK_API_KEY
-        self.api_url = DEEPSEEK_API_URL
-        self.grammar_checker = None
-        self.similarity_model = None
-        self.morph = None
+        self.buffer = ""
+    
+    def feed(self, chunk):
+        self.buffer += chunk
+        sentences = []
+        position = 0
+        for match in self.BOUNDARY.finditer(self.buffer):
+            # Пробелы в самом конце буфера могут продолжиться в следующей части
+            if match.end() == len(self.buffer):
+                break
+            sentence = self.buffer[position:match.start()].strip()
+            if sentence:
+                sentences.append((sentence, match.group().count('\n') >= 2))
+            position = match.end()
+        self.buffer = self.buffer[position:]
+        return sentences
+    
+    def flush(self):
+        sentence = self.buffer.strip()
+        self.buffer = ""
+        return [(sentence, True)] if sentence else []
+
+class MarkdownStreamCleaner:
+    """Убирает из потокового текста раздела разметку markdown.
+    
+    Строки-заголовки (# ...) и строка с повтором названия раздела удаляются
+    целиком, ** выделения убираются. Начало строки придерживается, пока по нему
+    нельзя понять, заголовок ли это; остальной текст отдается сразу, чтобы
+    SentenceStreamSplitter получал его без задержки.
+    """
+    def __init__(self, title):
+        self.title = title.lower()
+        self.buffer = ""
+        self.line_start = True
+    
+    def _is_heading(self, line):
+        line = line.strip()
+        return line.startswith('#') or line.replace('**', '').lower().rstrip('.') == self.title
+    
+    def _undecided(self, line):
+        line = line.strip()
+        return not line or line.startswith('#') or self.title.startswith(line.replace('*', '').lower())
+    
+    def feed(self, chunk):
+        self.buffer += chunk
+        output = []
+        while self.buffer:
+            newline = self.buffer.find('\n')
+            if self.line_start:
+                if newline >= 0:
+                    line = self.buffer[:newline]
+                    if not self._is_heading(line):
+                        output.append(line.replace('**', '') + '\n')
+                    self.buffer = self.buffer[newline + 1:]
+                    continue
+                if self._undecided(self.buffer):
+                    break
+                self.line_start = False
+            if newline >= 0:
+                output.append(self.buffer[:newline + 1].replace('**', ''))
+                self.buffer = self.buffer[newline + 1:]
+                self.line_start = True
+                continue
+            # * в конце может оказаться частью **, продолжение придет следующей частью
+            keep = len(self.buffer) - len(self.buffer.rstrip('*'))
+            output.append(self.buffer[:len(self.buffer) - keep].replace('**', ''))
+            self.buffer = self.buffer[len(self.buffer) - keep:]
+            break
+        return "".join(output)
+    
+    def flush(self):
+        text = self.buffer
+        self.buffer = ""
+        if self.line_start and self._is_heading(text):
+            return ""
+        return text.replace('**', '')
+
+class QuantizedGrammarModel:
+    """Оптимизированный CPU-бэкенд модели грамматики.
+    
+    Линейные слои квантуются в int8 (dynamic quantization), число потоков
+    torch задается явно, генерация идет в inference_mode. Число лучей
+    выбирается по бюджету задержки: если beam search на калибровочной фразе
+    дольше бюджета, используется жадный поиск. Вызов совместим с
+    transformers.pipeline("text2text-generation").
+    """
+    CALIBRATION_TEXT = "Результаты исследования показывают что предложеный метод позволяет повысить эффективность работы."
+    
+    def __init__(self, model_name=GRAMMAR_MODEL_NAME, threads=GRAMMAR_THREADS,
+                 latency_budget_ms=GRAMMAR_LATENCY_BUDGET_MS, quantize=True):
+        import torch
+        from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+        
+        if threads:
+            torch.set_num_threads(threads)
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+        model.eval()
+        if quantize:
+            model = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.model = model
+        self.num_beams = GRAMMAR_GENERATION_PARAMS['num_beams']
+        self.num_beams = self._choose_num_beams(latency_budget_ms)
+    
+    def _choose_num_beams(self, latency_budget_ms):
+        if self.num_beams <= 1 or not latency_budget_ms:
+            return self.num_beams
+        # Первый прогон прогревает модель и не учитывается
+        self(self.CALIBRATION_TEXT)
+        started_at = time.perf_counter()
+        self(self.CALIBRATION_TEXT)
+        latency_ms = (time.perf_counter() - started_at) * 1000
+        if latency_ms > latency_budget_ms:
+            logger.info(f"Grammar beam search takes {latency_ms:.0f} ms > {latency_budget_ms:.0f} ms budget, using greedy decoding")
+            return 1
+        return self.num_beams
+    
+    def __call__(self, texts, max_length=100, num_beams=None, batch_size=None):
+        batch = [texts] if isinstance(texts, str) else list(texts)
+        num_beams = min(num_beams or self.num_beams, self.num_beams)
+        with self.torch.inference_mode():
+            encoded = self.tokenizer(batch, return_tensors='pt', padding=True, truncation=True, max_length=max_length)
+            output_ids = self.model.generate(
+                input_ids=encoded['input_ids'], attention_mask=encoded['attention_mask'],
+                max_length=max_length, num_beams=num_beams, do_sample=False
+            )
+        return [{'generated_text': text} for text in self.tokenizer.batch_decode(output_ids, skip_special_tokens=True)]
+
+class ModelRegistry:
+    """Ленивая загрузка моделей с учетом состояния для /ready.
+    
+    Модель загружается при первом get() (потокобезопасно) или заранее в фоне
+    через warm_up(). Неудачная загрузка не повторяется: get() вернет None.
+    Готовность - это завершенный прогрев и загруженные модели из warm_up();
+    остальные модели необязательны и на нее не влияют.
+    """
+    def __init__(self):
+        self.loaders = {}
+        self.models = {}
+        self.status = {}
+        self.warmup_names = []
+        self.warmed_up = False
+        self._locks = {}
+    
+    def register(self, name, loader):
+        self.loaders[name] = loader
+        self.status[name] = {'state': 'not_loaded', 'load_time': None, 'error': None}
+        self._locks[name] = Lock()
+    
+    def get(self, name):
+        if name in self.models:
+            return self.models[name]
+        with self._locks[name]:
+            if name in self.models:
+                return self.models[name]
+            if self.status[name]['state'] == 'failed':
+                return None
+            
+            self.status[name]['state'] = 'loading'
+            started_at = time.monotonic()
+            try:
+                model = self.loaders[name]()
+            except Exception as e:
+                logger.error(f"Error loading model {name}: {e}")
+                self.status[name].update(state='failed', error=str(e))
+                return None
+            
+            load_time = time.monotonic() - started_at
+            self.models[name] = model
+            self.status[name].update(state='ready', load_time=round(load_time, 2))
+            logger.info(f"Model {name} loaded in {load_time:.1f}s")
+            return model
+    
+    def warm_up(self, names):
+        self.warmup_names = [name for name in names if name in self.loaders]
+        Thread(target=self._warm_up, daemon=True).start()
+    
+    def _warm_up(self):
+        for name in self.warmup_names:
+            self.get(name)
+        self.warmed_up = True
+    
+    def is_ready(self):
+        return self.warmed_up and all(self.status[name]['state'] == 'ready' for name in self.warmup_names)
+    
+    def snapshot(self):
+        return {name: dict(status) for name, status in self.status.items()}
+
+def load_grammar_model():
+    if GRAMMAR_BACKEND == 'quantized':
+        return QuantizedGrammarModel()
+    from transformers import pipeline
+    return pipeline("text2text-generation", model=GRAMMAR_MODEL_NAME, device=-1)
+
+def load_similarity_model():
+    from sentence_transformers import SentenceTransformer
+    return SentenceTransformer(SIMILARITY_MODEL_NAME)
+
+def load_morph_analyzer():
+    import pymorphy3
+    return pymorphy3.MorphAnalyzer()
+
+model_registry = ModelRegistry()
+model_registry.register('grammar', load_grammar_model)
+model_registry.register('similarity', load_similarity_model)
+model_registry.register('morph', load_morph_analyzer)
+
+class MorphNormalizer:
+    """Общий сервис нормализации слов с памятью лемм.
+    
+    Разбор pymorphy3 для каждой словоформы выполняется один раз: результат
+    хранится в ограниченном LRU (functools.lru_cache потокобезопасен). Леммы
+    берутся из тех же разборов, что и у GrammarTriage, поэтому хэш предложения
+    и отбор для модели грамматики не разбирают одно слово дважды.
+    normalize_document() за один проход делит текст на предложения и
+    возвращает для каждого массив лемм.
+    """
+    WORD_PATTERN = re.compile(r'\w+')
+    
+    def __init__(self, get_morph, maxsize=MORPH_CACHE_SIZE):
+        self.get_morph = get_morph
+        self.lemma = lru_cache(maxsize=maxsize)(self._lemma)
+        self.parses = lru_cache(maxsize=maxsize)(self._parses)
+        self.is_known = lru_cache(maxsize=maxsize)(self._is_known)
+    
+    def _lemma(self, word):
+        try:
+            parses = self.parses(word)
+        except Exception:
+            return word
+        return parses[0].normal_form if parses else word
+    
+    def _parses(self, word):
+        morph = self.get_morph()
+        return tuple(morph.parse(word)) if morph else ()
+    
+    def _is_known(self, word):
+        morph = self.get_morph()
+        return morph.word_is_known(word) if morph else True
+    
+    def tokenize(self, text):
+        return self.WORD_PATTERN.findall(text.lower())
+    
+    def normalize(self, text, limit=None):
+        words = self.tokenize(text)
+        if limit is not None:
+            words = words[:limit]
+        lemma = self.lemma
+        return [lemma(word) for word in words]
+    
+    def normalize_document(self, text):
+        """Список (предложение, конец_абзаца, леммы) для всего текста."""
+        splitter = SentenceStreamSplitter()
+        return [
+            (sentence, paragraph_end, self.normalize(sentence))
+            for sentence, paragraph_end in splitter.feed(text) + splitter.flush()
+        ]
+    
+    def stats(self):
+        info = self.lemma.cache_info()
+        total = info.hits + info.misses
+        return {
+            'hits': info.hits,
+            'misses': info.misses,
+            'size': info.currsize,
+            'hit_rate': info.hits / total if total else 0.0
+        }
+
+morph_normalizer = MorphNormalizer(lambda: model_registry.get('morph'))
+
+def extract_main_text(html, limit=1500, chunk_size=16384):
+    """Текст основной части страницы, не длиннее limit символов.
+    
+    HTML разбирается lxml.etree.HTMLPullParser по частям; текст собирается из
+    текстовых блоков (абзацы, пункты списков, заголовки), служебные разделы
+    пропускаются. Блоки внутри <article>/<main> имеют приоритет. Разбор
+    прекращается, как только основной текст набран, а разобранные элементы
+    очищаются, поэтому память не растет с размером страницы.
+    """
+    from lxml import etree
+    
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    main_blocks, all_blocks = [], []
+    state = {'main': 0, 'all': 0, 'skip_depth': 0, 'main_depth': 0, 'seen_main': False}
+    
+    def read_events():
+        """Обрабатывает накопленные события; True, когда текста достаточно."""
+        for event, element in parser.read_events():
+            tag = element.tag
+            if not isinstance(tag, str):
+                continue
+            if event == 'start':
+                if tag in HTML_SKIP_TAGS:
+                    state['skip_depth'] += 1
+                elif tag in HTML_MAIN_TAGS:
+                    state['main_depth'] += 1
+                    state['seen_main'] = True
+                continue
+            
+            if tag in HTML_SKIP_TAGS:
+                state['skip_depth'] -= 1
+                element.clear(keep_tail=True)
+            elif tag in HTML_MAIN_TAGS:
+                state['main_depth'] -= 1
+            elif tag in HTML_TEXT_TAGS:
+                if not state['skip_depth']:
+                    text = ' '.join(''.join(element.itertext()).split())
+                    if text:
+                        all_blocks.append(text)
+                        state['all'] += len(text) + 1
+                        if state['main_depth']:
+                            main_blocks.append(text)
+                            state['main'] += len(text) + 1
+                element.clear(keep_tail=True)
+            
+            # Если <article>/<main> не встретился, ждем не дольше двух лимитов текста
+            if state['main'] >= limit or (not state['seen_main'] and state['all'] >= limit * 2):
+                return True
+        return False
+    
+    done = False
+    for position in range(0, len(html), chunk_size):
+        parser.feed(html[position:position + chunk_size])
+        done = read_events()
+        if done:
+            break
+    if not done:
+        try:
+            parser.close()
+        except etree.LxmlError:
+            pass
+        read_events()
+    
+    blocks = main_blocks if state['main'] >= limit // 3 else all_blocks
+    return ' '.join(blocks)[:limit]
+
+def extract_text_soup(html, limit=1500):
+    """Полный разбор страницы BeautifulSoup: весь видимый текст без служебных разделов."""
+    from bs4 import BeautifulSoup
+    
+    soup = BeautifulSoup(html, 'html.parser')
+    
+    for tag in soup(['script', 'style', 'nav', 'footer', 'header']):
+        tag.decompose()
+    
+    text = soup.get_text()
+    lines = (line.strip() for line in text.splitlines())
+    chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
+    text = ' '.join(chunk for chunk in chunks if chunk)
+    
+    return text[:limit]
+
+def web_search(query, num_results):
+    from googlesearch import search
+    return list(search(query, num_results=num_results, lang='ru'))
+
+class GrammarTriage:
+    """Быстрая оценка, нужна ли предложению проверка моделью грамматики.
+    
+    Складывает веса простых признаков ошибок: regex, слова, которых нет в
+    словаре pymorphy3 (обычно опечатки), и нарушения согласования по разборам
+    из MorphNormalizer. Предложения с суммой ниже порога считаются корректными
+    и не отправляются в T5.
+    """
+    RULES = [
+        (PASSIVE_INFINITIVE_PATTERN, 1.0),
+        (CASE_BREAK_PATTERN, 1.0),
+        (re.compile(r'\b(\w+)\s+\1\b', re.IGNORECASE), 1.0),
+        (re.compile(r'\s[,.;:!?]'), 1.0),
+        (re.compile(r'[,;:](?=[А-Яа-яЁё])'), 1.0),
+        (re.compile(r'[а-яё][a-z]|[a-z][а-яё]', re.IGNORECASE), 1.0),
+        (re.compile(r'\s{2,}'), 0.5),
+        (re.compile(r'^[а-яё]'), 0.5),
+        (re.compile(r'[^.!?…»")]$'), 0.5)
+    ]
+    WORD_PATTERN = re.compile(r'[А-Яа-яЁё]+')
+    
+    def __init__(self, normalizer=None, threshold=GRAMMAR_TRIAGE_THRESHOLD):
+        self.normalizer = normalizer
+        self.threshold = threshold
+        self.skipped = 0
+        self.flagged = 0
+        self._lock = Lock()
+    
+    def score(self, sentence):
+        score = sum(weight for pattern, weight in self.RULES if pattern.search(sentence))
+        if sentence.count('(') != sentence.count(')') or sentence.count('«') != sentence.count('»'):
+            score += 0.5
+        if len(sentence.split()) > 40:
+            score += 0.5
+        if self.normalizer and score < self.threshold:
+            score += self._morphology_errors(sentence)
+        return score
+    
+    def needs_correction(self, sentence):
+        flagged = self.score(sentence) >= self.threshold
+        with self._lock:
+            if flagged:
+                self.flagged += 1
+            else:
+                self.skipped += 1
+        return flagged
+    
+    def _morphology_errors(self, sentence):
+        """Число незнакомых слов и нарушений согласования.
+        
+        Прилагательные и причастия перед существительным должны согласоваться с
+        ним все, а не только ближайшее. Глагол сразу после такой группы проверяется
+        по числу, если группа может стоять только в именительном или винительном
+        падеже, то есть, скорее всего, является подлежащим.
+        """
+        errors = 0
+        adjectives = []
+        phrase = None
+        for index, match in enumerate(self.WORD_PATTERN.finditer(sentence)):
+            word = match.group()
+            lower = word.lower()
+            # Слова с заглавной буквы внутри предложения - обычно имена и названия
+            if (index == 0 or word[0].islower()) and len(word) > 2 and not self.normalizer.is_known(lower):
+                errors += 1
+                adjectives, phrase = [], None
+                continue
+            
+            parses = [parse for parse in self.normalizer.parses(lower) if parse.score > 0.1]
+            adjective_parses = [parse for parse in parses if parse.tag.POS in ('ADJF', 'PRTF')]
+            noun_parses = [parse for parse in parses if parse.tag.POS == 'NOUN']
+            verb_parses = [parse for parse in parses if parse.tag.POS == 'VERB' and 'indc' in parse.tag]
+            
+            if parses and len(adjective_parses) == len(parses):
+                adjectives.append(adjective_parses)
+                phrase = None
+                continue
+            if noun_parses:
+                forms = {
+                    (noun.tag.case, noun.tag.number) for noun in noun_parses
+                    if all(any(self._agree(adjective.tag, noun.tag) for adjective in chain) for chain in adjectives)
+                }
+                if adjectives and not forms:
+                    errors += 1
+                phrase = forms or None
+                adjectives = []
+                continue
+            if phrase and verb_parses and len(verb_parses) == len(parses):
+                cases = {case for case, _ in phrase}
+                numbers = {number for _, number in phrase}
+                if 'nomn' in cases and cases <= {'nomn', 'accs'} and not numbers & {verb.tag.number for verb in verb_parses}:
+                    errors += 1
+            adjectives, phrase = [], None
+        return errors
+    
+    @staticmethod
+    def _agree(adjective, noun):
+        if adjective.case != noun.case or adjective.number != noun.number:
+            # Несклоняемые и двувидовые разборы не считаем ошибкой
+            return 'Fixd' in noun or noun.case is None
+        if adjective.number == 'sing' and adjective.gender and noun.gender and 'ms-f' not in noun:
+            return adjective.gender == noun.gender
+        return True
+    
+    def stats(self):
+        total = self.skipped + self.flagged
+        return {
+            'skipped': self.skipped,
+            'sent_to_model': self.flagged,
+            'skip_rate': self.skipped / total if total else 0.0
+        }
+
+class GrammarBatcher:
+    """Собирает предложения из параллельных потоков в пакеты для модели грамматики.
+    
+    correct() ждет результата для одного предложения, а обработка идет пакетами:
+    пока выполняется один пакет, в очереди накапливается следующий.
+    """
+    def __init__(self, correct_batch, run_cpu, batch_size=GRAMMAR_BATCH_SIZE, max_wait=GRAMMAR_BATCH_WAIT):
+        self.correct_batch = correct_batch
+        self.run_cpu = run_cpu
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.pending = []
+        self._task = None
+    
+    async def correct(self, sentence):
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((sentence, future))
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+        return await future
+    
+    async def _drain(self):
+        while self.pending:
+            if len(self.pending) < self.batch_size:
+                await asyncio.sleep(self.max_wait)
+            # Окно в несколько пакетов: внутри него предложения сортируются по длине
+            window = self.batch_size * 4
+            batch, self.pending = self.pending[:window], self.pending[window:]
+            sentences = [sentence for sentence, _ in batch]
+            try:
+                results = await self.run_cpu(self.correct_batch, sentences)
+            except Exception as e:
+                logger.error(f"Grammar batch error: {e}")
+                results = sentences
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+class ClicheRewriter:
+    """Замена штампов за один проход по тексту.
+    
+    Фразы словаря хранятся в префиксном дереве по словам, поэтому для каждого
+    слова текста выполняется спуск не глубже самой длинной фразы, и стоимость
+    не зависит от размера словаря. Совпадают только словоформы, записанные в
+    словаре: замена - фиксированная строка, и для других падежей и чисел она
+    была бы неграмматичной. Слова фразы в тексте должны разделяться только
+    пробелами.
+    """
+    WORD_PATTERN = re.compile(r'\w+')
+    
+    def __init__(self, cliches=DEFAULT_CLICHES, path=CLICHES_PATH):
+        self.cliches = dict(cliches)
+        if path and os.path.exists(path):
+            self.cliches.update(self.load(path))
+        self.trie = {}
+        for cliche, replacement in self.cliches.items():
+            node = self.trie
+            for word in self.WORD_PATTERN.findall(cliche.lower()):
+                node = node.setdefault(word, {})
+            node[None] = replacement
+        logger.info(f"Cliche dictionary loaded: {len(self.cliches)} phrases")
+    
+    @staticmethod
+    def load(path):
+        cliches = {}
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line or line.startswith('#') or '->' not in line:
+                    continue
+                cliche, replacement = (part.strip() for part in line.split('->', 1))
+                if cliche and replacement:
+                    cliches[cliche] = replacement
+        return cliches
+    
+    def rewrite(self, text):
+        trie = self.trie
+        words = list(self.WORD_PATTERN.finditer(text))
+        parts = []
+        position = 0
+        i = 0
+        while i < len(words):
+            node = trie
+            match = None
+            j = i
+            while j < len(words):
+                if j > i and not text[words[j - 1].end():words[j].start()].isspace():
+                    break
+                node = node.get(words[j].group().lower())
+                if node is None:
+                    break
+                j += 1
+                if None in node:
+                    match = (j, node[None])
+            if match is None:
+                i += 1
+                continue
+            
+            end, replacement = match
+            start = words[i].start()
+            if text[start].islower():
+                replacement = replacement[0].lower() + replacement[1:]
+            else:
+                replacement = replacement[0].upper() + replacement[1:]
+            parts.append(text[position:start])
+            parts.append(replacement)
+            position = words[end - 1].end()
+            i = end
+        
+        if not parts:
+            return text
+        parts.append(text[position:])
+        return ''.join(parts)
+
+class EnhancedAcademicWriter:
+    def __init__(self, search=web_search, transport=None):
+        self.deepseek = DeepSeekClient(DEEPSEEK_API_KEY, DEEPSEEK_API_URL)
         self.used_phrases = set()
+        self.search = search
+        self.transport = transport
+        self.http_client = None
+        self._host_limits = {}
+        self.response_cache = LLMResponseCache()
+        self.page_cache = PageCache()
+        self.source_index = SourceIndex(morph_normalizer)
+        self.source_vectors = VectorStore()
+        self.cpu_executor = ThreadPoolExecutor(max_workers=CPU_WORKERS, thread_name_prefix="cpu")
+        self._grammar_lock = Lock()
+        self.grammar_batcher = GrammarBatcher(self._correct_sentences, self.run_cpu)
+        self.grammar_triage = GrammarTriage(morph_normalizer) if GRAMMAR_TRIAGE else None
+        self._grammar_cache = None
+        self._grammar_cache_lock = Lock()
+        self.normalizer = morph_normalizer
+        self.cliche_rewriter = ClicheRewriter()
+    
+    # Модели загружаются при первом обращении (см. model_registry)
+    @property
+    def grammar_checker(self):
+        return model_registry.get('grammar')
+    
+    @property
+    def similarity_model(self):
+        return model_registry.get('similarity')
+    
+    @property
+    def morph(self):
+        return model_registry.get('morph')
+    
+    @property
+    def grammar_cache(self):
+        # Ключ кэша зависит от фактического числа лучей загруженного бэкенда
+        with self._grammar_cache_lock:
+            if self._grammar_cache is None:
+                num_beams = getattr(self.grammar_checker, 'num_beams', GRAMMAR_GENERATION_PARAMS['num_beams'])
+                self._grammar_cache = GrammarCache(
+                    f"{GRAMMAR_MODEL_NAME}:{GRAMMAR_BACKEND}", {**GRAMMAR_GENERATION_PARAMS, 'num_beams': num_beams}
+                )
+            return self._grammar_cache
+    
+    def _get_http_client(self):
+        if self.http_client is None or self.http_client.is_closed:
+            self.http_client = httpx.AsyncClient(
+                headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'},
+                follow_redirects=True,
+                timeout=SOURCE_FETCH_TIMEOUT,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+                transport=self.transport
+            )
+        return self.http_client
+    
+    async def run_cpu(self, func, *args, **kwargs):
+        """Выполняет CPU-задачу в ограниченном пуле потоков, не блокируя event loop."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.cpu_executor, partial(func, *args, **kwargs))
+    
+    async def close(self):
+        if self.http_client is not None:
+            await self.http_client.aclose()
+            self.http_client = None
+        await self.deepseek.close()
+        self.cpu_executor.shutdown(wait=False)
+    
+    async def _report_progress(self, progress, stage, details):
+        if not progress:
+            return
+        try:
+            await progress(stage, details)
+        except Exception as e:
+            logger.warning(f"Progress update error: {e}")
+    
+    async def generate_complete_work(self, work_type, topic, subject, methodic_info=None, progress=None, fresh=False,
+                                     prefetched_sources=None, outline_titles=None):
+        """prefetched_sources - задача поиска источников, запущенная заранее (см. prefetch_sources).
+        
+        В список outline_titles записываются заголовки разделов готовой работы,
+        чтобы оглавление документа совпало с заголовками в тексте.
+        """
+        await self._report_progress(progress, 1, "🔍 Ищу релевантные исследования и публикации...")
+        sources = None
+        if prefetched_sources is not None and not prefetched_sources.cancelled():
+            try:
+                # shield: отмена генерации не отменяет общий поиск, а отмена самого
+                # поиска (задача поиска помечена отмененной) ведет к новому поиску
+                sources = await asyncio.shield(prefetched_sources)
+                logger.info(f"Using prefetched sources: {len(sources)}")
+            except asyncio.CancelledError:
+                if not prefetched_sources.cancelled():
+                    raise
+                logger.warning("Prefetched source search was cancelled")
+            except Exception as e:
+                logger.warning(f"Prefetched source search failed: {e}")
+        if sources is None:
+            sources = await self._search_academic_sources(topic, subject)
+        logger.info(f"Page cache stats: {self.page_cache.stats()}")
+        
+        system_prompt = self._create_enhanced_prompt(work_type, topic, subject, methodic_info, sources)
+        
+        await self._report_progress(progress, 2, f"📝 Источников найдено: {len(sources)}. Составляю план работы...")
+        outline = await self._build_outline(work_type, topic, subject, methodic_info, system_prompt, fresh)
+        
+        sections = await self._generate_sections(work_type, topic, outline, system_prompt, progress, fresh)
+        if isinstance(sections, str):
+            return sections
+        if outline_titles is not None:
+            outline_titles[:] = [section['title'] for section in outline]
+        
+        word_count = sum(len(text.split()) for section in sections for _, text, _ in section)
+        await self._report_progress(progress, 3, f"✅ Получено {word_count} слов. Завершаю проверку грамматики и стиля...")
+        if self._grammar_cache:
+            logger.info(f"Grammar cache stats: {self._grammar_cache.stats()}")
+        if self.grammar_triage:
+            logger.info(f"Grammar triage stats: {self.grammar_triage.stats()}")
+        logger.info(f"Morph normalizer stats: {self.normalizer.stats()}")
+        return await self.run_cpu(self._assemble_work, outline, sections)
+    
+    def prefetch_sources(self, topic, subject):
+        """Запускает поиск источников в фоне, пока пользователь заполняет остальные данные."""
+        return asyncio.create_task(self._search_academic_sources(topic, subject))
+    
+    async def _build_outline(self, work_type, topic, subject, methodic_info, system_prompt, fresh=False):
+        """Запрашивает у модели план работы и приводит его к структуре из методички.
+        
+        Возвращает список разделов вида {'title', 'points', 'words'}. Если модель
+        вернула некорректный план, используется стандартный.
+        """
+        outline = self._default_outline(work_type, methodic_info)
+        chapters = [section for section in outline if section['title'].startswith('Глава')]
+        
+        user_prompt = (
+            f"Составь подробный план {self._get_work_type_name(work_type)} на тему '{topic}' по предмету '{subject}'.\n"
+            f"Количество глав: {len(chapters)}.\n"
+            "Верни ТОЛЬКО JSON без пояснений в формате:\n"
+            '{"introduction": ["пункт", ...], '
+            '"chapters": [{"title": "название главы", "points": ["пункт", ...]}, ...], '
+            '"conclusion": ["пункт", ...]}'
+        )
+        response = await self._make_api_call(system_prompt, user_prompt, max_tokens=1500, temperature=0.5, fresh=fresh)
+        if response.startswith("❌") or response.startswith("⏰"):
+            logger.warning("Outline request failed, using default outline")
+            return outline
+        
+        try:
+            plan = json.loads(response[response.index('{'):response.rindex('}') + 1])
+        except (ValueError, TypeError):
+            logger.warning("Invalid outline JSON, using default outline")
+            return outline
+        
+        planned_chapters = [chapter for chapter in plan.get('chapters', []) if isinstance(chapter, dict)]
+        for i, section in enumerate(chapters):
+            if i < len(planned_chapters):
+                title = str(planned_chapters[i].get('title', '')).strip().rstrip('.')
+                title = re.sub(r'^(?:глава\s*\d+\.?\s*)', '', title, flags=re.IGNORECASE)
+                if title:
+                    section['title'] = f"Глава {i + 1}. {title[:150]}"
+                section['points'] = [str(point) for point in planned_chapters[i].get('points', [])][:8]
+        
+        for section in outline:
+            if section['title'] == 'Введение':
+                section['points'] = [str(point) for point in plan.get('introduction', [])][:8]
+            elif section['title'] == 'Заключение':
+                section['points'] = [str(point) for point in plan.get('conclusion', [])][:8]
         
-        # Инициализация моделей
+        return outline
+    
+    def _default_outline(self, work_type, methodic_info):
+        work_structure = (methodic_info or {}).get('work_structure') or {}
+        required_sections = [section.lower() for section in work_structure.get('required_sections', [])]
         try:
-            self.grammar_checker = pipeline("text2text-generation", model="cointegrated/rut5-base-grammar-correction", device=-1)
-            self.similarity_model = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
-            self.morph = pymorphy3.MorphAnalyzer()
-        except Exception as e:
-            logger.error(f"Error initializing models: {e}")
+            chapter_count = min(max(int(work_structure.get('chapter_count', 3)), 1), 6)
+        except (TypeError, ValueError):
+            chapter_count = 3
+        
+        has_introduction = work_structure.get('has_introduction', True) or 'введение' in required_sections
+        has_conclusion = work_structure.get('has_conclusion', True) or 'заключение' in required_sections
+        
+        # Список литературы и приложения добавляются при сборке документа
+        target_words = self._get_target_word_count(work_type)
+        intro_words = int(target_words * 0.1) if has_introduction else 0
+        conclusion_words = int(target_words * 0.08) if has_conclusion else 0
+        chapter_words = (target_words - intro_words - conclusion_words) // chapter_count
+        
+        outline = []
+        if has_introduction:
+            outline.append({'title': 'Введение', 'points': [], 'words': intro_words})
+        for i in range(1, chapter_count + 1):
+            outline.append({
+                'title': f"Глава {i}. {DEFAULT_CHAPTER_TITLES.get(i, 'Основная часть')}",
+                'points': [],
+                'words': chapter_words
+            })
+        if has_conclusion:
+            outline.append({'title': 'Заключение', 'points': [], 'words': conclusion_words})
+        return outline
     
-    def generate_complete_work(self, work_type, topic, subject, methodic_info=None):
-        work_type_names = {
-            "coursework": "курсовой работы",
-            "essay": "реферата", 
-            "thesis": "дипломной работы"
-        }
+    async def _generate_sections(self, work_type, topic, outline, system_prompt, progress=None, fresh=False):
+        """Пишет все разделы плана параллельно.
         
-        sources = self._search_academic_sources(topic, subject)
+        Разделы больше SECTION_MAX_WORDS делятся на части, чтобы каждый ответ
+        укладывался в лимит токенов одного запроса. Ответы читаются потоком:
+        законченные предложения сразу уходят на постобработку в пул CPU, пока
+        модель продолжает писать. Без потока (DEEPSEEK_STREAMING=0) предложения
+        раздела обрабатываются одним пакетом. Точные повторы отсеиваются по хэшу
+        до проверки грамматики и приходят с предложением None. Возвращает для
+        каждого раздела список (хэш, предложение, конец_абзаца) в исходном порядке
+        или строку ошибки.
+        """
+        semaphore = asyncio.Semaphore(SECTION_CONCURRENCY)
+        # Общие для всех частей: повтор из другого раздела тоже не идет в модель грамматики
+        seen_hashes = set()
+        outline_text = "\n".join(section['title'] for section in outline)
+        loop = asyncio.get_running_loop()
         
-        system_prompt = self._create_enhanced_prompt(work_type, topic, subject, methodic_info, sources)
+        jobs = []
+        for index, section in enumerate(outline):
+            parts = max(1, -(-section['words'] // SECTION_MAX_WORDS))
+            for part in range(parts):
+                jobs.append((index, part, parts))
         
-        full_content = self._make_api_call(
-            system_prompt,
-            f"Напиши полный текст {work_type_names[work_type]} на тему '{topic}' объемом не менее {self._get_target_word_count(work_type)} слов."
-        )
+        done = 0
+        received_words = 0
+        last_report = loop.time()
+        
+        async def report_received():
+            nonlocal last_report
+            if loop.time() - last_report >= PROGRESS_INTERVAL:
+                last_report = loop.time()
+                await self._report_progress(
+                    progress, 2,
+                    f"📝 Получено слов: {received_words}\n📑 Готово частей: {done}/{len(jobs)}"
+                )
+        
+        async def run_job(index, part, parts):
+            nonlocal done, received_words
+            section = outline[index]
+            words = section['words'] // parts
+            points = section['points'][part::parts] if section['points'] else []
+            user_prompt = (
+                f"Напиши раздел «{section['title']}» {self._get_work_type_name(work_type)} на тему '{topic}'.\n"
+                f"План всей работы:\n{outline_text}\n\n"
+            )
+            if parts > 1:
+                user_prompt += f"Это часть {part + 1} из {parts} данного раздела, не повторяй другие части.\n"
+            if points:
+                user_prompt += "Раскрой пункты:\n" + "\n".join(f"- {point}" for point in points) + "\n"
+            user_prompt += (
+                f"Объем: не менее {words} слов. "
+                "Пиши только связный текст без заголовков, разделяя абзацы пустой строкой."
+            )
+            
+            # Разметка убирается построчно до деления на предложения
+            cleaner = MarkdownStreamCleaner(section['title'])
+            splitter = SentenceStreamSplitter()
+            pending = []
+            
+            def submit(sentences):
+                nonlocal received_words
+                for sentence, paragraph_end in sentences:
+                    received_words += len(sentence.split())
+                    pending.append((asyncio.ensure_future(self._process_sentence(sentence, seen_hashes)), paragraph_end))
+            
+            async def on_text(delta):
+                submit(splitter.feed(cleaner.feed(delta)))
+                await report_received()
+            
+            # Незавершенная обработка предложений отменяется при ошибке или отмене части
+            try:
+                async with semaphore:
+                    text = await self._make_api_call(
+                        system_prompt, user_prompt,
+                        max_tokens=min(8000, words * 3 + 500),
+                        on_text=on_text if DEEPSEEK_STREAMING else None,
+                        fresh=fresh
+                    )
+                
+                if text.startswith("❌") or text.startswith("⏰"):
+                    return text
+                
+                if DEEPSEEK_STREAMING:
+                    submit(splitter.feed(cleaner.flush()))
+                    submit(splitter.flush())
+                
+                    processed = []
+                    for future, paragraph_end in pending:
+                        sentence_hash, sentence = await future
+                        processed.append((sentence_hash, sentence, paragraph_end))
+                else:
+                    # Раздел получен целиком: предложения и леммы - одним проходом, грамматика - одним пакетным вызовом
+                    document = await self.run_cpu(self.normalizer.normalize_document, cleaner.feed(text) + cleaner.flush())
+                    received_words += sum(len(sentence.split()) for sentence, _, _ in document)
+                    results = await self.run_cpu(self._process_sentences, document, seen_hashes)
+                    processed = [
+                        (sentence_hash, sentence, paragraph_end)
+                        for (sentence_hash, sentence), (_, paragraph_end, _) in zip(results, document)
+                    ]
+                
+                done += 1
+                await report_received()
+                return processed
+            finally:
+                for future, _ in pending:
+                    future.cancel()
+        
+        # Первая ошибка останавливает остальные части, чтобы не тратить запросы к API
+        tasks = [asyncio.ensure_future(run_job(*job)) for job in jobs]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                result = await finished
+                if isinstance(result, str):
+                    return result
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        
+        sections = [[] for _ in outline]
+        for (index, part, parts), task in zip(jobs, tasks):
+            result = task.result()
+            if sections[index] and result:
+                # Части одного раздела разделяются абзацем
+                last_hash, last_sentence, _ = sections[index][-1]
+                sections[index][-1] = (last_hash, last_sentence, True)
+            sections[index].extend(result)
+        return sections
+    
+    def _assemble_work(self, outline, sections):
+        # Основная часть точных повторов отсеяна до грамматики; здесь - оставшиеся
+        # по хэшу в порядке документа, затем смысловые
+        seen_hashes = set()
+        deduped = []
+        for processed in sections:
+            section = []
+            for sentence_hash, sentence, paragraph_end in processed:
+                if sentence is not None and sentence_hash in seen_hashes:
+                    sentence = None
+                elif sentence is not None:
+                    seen_hashes.add(sentence_hash)
+                section.append((sentence_hash, sentence, paragraph_end))
+            deduped.append(section)
+        deduped = self._drop_semantic_duplicates(deduped)
+        
+        parts = []
+        for section, processed in zip(outline, deduped):
+            body = self._join_sentences(processed, set())
+            parts.append(f"{section['title']}\n\n{body}")
+        return "\n\n".join(parts)
+    
+    def _drop_semantic_duplicates(self, sections):
+        """Заменяет на None предложения, близкие по смыслу к уже встречавшимся."""
+        sentences = [sentence for section in sections for _, sentence, _ in section if sentence is not None]
+        if not SEMANTIC_DEDUP or len(sentences) < 2 or not self.similarity_model:
+            return sections
         
-        if not full_content.startswith("❌") and not full_content.startswith("⏰"):
-            enhanced_content = self._enhance_content_quality(full_content, topic, subject)
-            return enhanced_content
+        try:
+            embeddings = self.similarity_model.encode(
+                sentences, batch_size=64, convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+            )
+        except Exception as e:
+            logger.error(f"Sentence embedding error: {e}")
+            return sections
+        keep = iter(find_near_duplicates(embeddings))
         
-        return full_content
+        result = []
+        dropped = 0
+        for section in sections:
+            filtered = []
+            for sentence_hash, sentence, paragraph_end in section:
+                if sentence is not None and not next(keep):
+                    sentence = None
+                    dropped += 1
+                filtered.append((sentence_hash, sentence, paragraph_end))
+            result.append(filtered)
+        logger.info(f"Semantic dedup dropped {dropped} of {len(sentences)} sentences")
+        return result
     
-    def _search_academic_sources(self, topic: str, subject: str) -> List[Dict]:
+    async def _search_academic_sources(self, topic: str, subject: str) -> List[Dict]:
         search_queries = [
             f"{topic} {subject} научная статья",
             f"{topic} исследования последние публикации",
@@ -558,77 +2810,163 @@ class EnhancedAcademicWriter:
             f"{subject} научный журнал публикации"
         ]
         
-        sources = []
-        seen_urls = set()
+        topic_words = set(await self.run_cpu(self.normalizer.normalize, topic))
+        sources = await self.run_cpu(self._search_index, topic_words)
+        if len(sources) >= 3:
+            logger.info(f"Sources found in local index: {len(sources)}")
+            return await self.run_cpu(self._rank_sources, topic, topic_words, sources)
+        seen_urls = {source['url'] for source in sources}
         
-        for query in search_queries[:2]:
+        async def fetch_source(url):
+            content, lemmas = await self._extract_academic_content(url)
+            if content and len(content) > 100:
+                sources.append({'url': url, 'content': content, 'lemmas': set(lemmas)})
+        
+        async def run_query(query):
             try:
-                for url in search(query, num_results=2, lang='ru'):
-                    if url not in seen_urls:
-                        content = self._extract_academic_content(url)
-                        if content and len(content) > 100:
-                            sources.append({
-                                'url': url,
-                                'content': content[:300],
-                                'relevance': self._calculate_relevance(content, topic)
-                            })
-                            seen_urls.add(url)
+                urls = await asyncio.to_thread(self.search, query, SOURCE_RESULTS_PER_QUERY)
             except Exception as e:
                 logger.error(f"Search error: {e}")
-                continue
+                return
+            fetches = []
+            for url in urls:
+                if url not in seen_urls:
+                    seen_urls.add(url)
+                    fetches.append(fetch_source(url))
+            await asyncio.gather(*fetches)
+        
+        # По истечении срока используются источники, полученные к этому моменту
+        try:
+            await asyncio.wait_for(
+                asyncio.gather(*(run_query(query) for query in search_queries[:SOURCE_QUERIES])),
+                SOURCE_STAGE_DEADLINE
+            )
+        except asyncio.TimeoutError:
+            logger.warning(f"Source search deadline reached: {len(sources)} of {len(seen_urls)} pages fetched in time")
         
-        return sorted(sources, key=lambda x: x['relevance'], reverse=True)[:3]
+        return await self.run_cpu(self._rank_sources, topic, topic_words, list(sources))
+    
+    def _search_index(self, topic_words: set) -> List[Dict]:
+        sources = []
+        for document in self.source_index.search(topic_words):
+            relevance = len(topic_words & document['lemmas']) / len(topic_words)
+            if relevance >= SOURCE_INDEX_MIN_RELEVANCE:
+                sources.append({'url': document['url'], 'content': document['content'], 'relevance': relevance})
+        return sorted(sources, key=lambda x: x['relevance'], reverse=True)
     
-    def _extract_academic_content(self, url: str) -> str:
+    def _rank_sources(self, topic: str, topic_words: set, candidates: List[Dict], limit=3) -> List[Dict]:
+        """Лучшие источники по сходству с темой; без модели эмбеддингов - по доле слов темы."""
+        if not candidates:
+            return []
+        relevance = self._embedding_relevance(topic, candidates)
+        if relevance is None:
+            relevance = [
+                candidate['relevance'] if 'relevance' in candidate
+                else self._calculate_relevance(candidate['lemmas'], topic_words)
+                for candidate in candidates
+            ]
+        ranked = sorted(zip(relevance, candidates), key=lambda x: x[0], reverse=True)[:limit]
+        return [
+            {'url': candidate['url'], 'content': candidate['content'][:300], 'relevance': float(score)}
+            for score, candidate in ranked
+        ]
+    
+    def _embedding_relevance(self, topic: str, candidates: List[Dict]):
+        """Косинусное сходство темы с источниками; векторы источников берутся из VectorStore."""
+        if not self.similarity_model:
+            return None
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-            }
-            response = requests.get(url, headers=headers, timeout=10)
-            soup = BeautifulSoup(response.text, 'html.parser')
-            
-            for tag in soup(['script', 'style', 'nav', 'footer', 'header']):
-                tag.decompose()
-            
-            text = soup.get_text()
-            lines = (line.strip() for line in text.splitlines())
-            chunks = (phrase.strip() for line in lines for phrase in line.split("  "))
-            text = ' '.join(chunk for chunk in chunks if chunk)
-            
-            return text[:1500]
-            
+            keys = [hashlib.sha1(candidate['content'].encode('utf-8')).hexdigest() for candidate in candidates]
+            missing = {key: candidate['content'] for key, candidate in zip(keys, candidates) if key not in self.source_vectors}
+            encode = partial(
+                self.similarity_model.encode,
+                convert_to_numpy=True, normalize_embeddings=True, show_progress_bar=False
+            )
+            if missing:
+                self.source_vectors.add(list(missing), encode(list(missing.values()), batch_size=32))
+            return self.source_vectors.scores(encode([topic])[0], keys)
+        except Exception as e:
+            logger.error(f"Source ranking error: {e}")
+            return None
+    
+    async def _extract_academic_content(self, url: str):
+        """(текст, леммы) страницы; леммы считаются один раз и идут и в индекс, и в оценку релевантности."""
+        cached = await asyncio.to_thread(self.page_cache.get, url)
+        if cached and cached['fresh']:
+            return cached['text'], await self.run_cpu(self._page_lemmas, cached['text'])
+        
+        validators = {}
+        if cached and cached['etag']:
+            validators['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            validators['If-Modified-Since'] = cached['last_modified']
+        
+        try:
+            host = httpx.URL(url).host
+            limit = self._host_limits.setdefault(host, asyncio.Semaphore(SOURCE_HOST_CONCURRENCY))
+            async with limit:
+                html, etag, last_modified = await self._fetch_page(url, validators)
+            if html is None:
+                await asyncio.to_thread(self.page_cache.touch, url)
+                return cached['text'], await self.run_cpu(self._page_lemmas, cached['text'])
+            text = await self.run_cpu(self._html_to_text, html) if html else ""
+            await asyncio.to_thread(self.page_cache.set, url, text, etag, last_modified)
+            lemmas = await self.run_cpu(self._page_lemmas, text)
+            if text:
+                await asyncio.to_thread(self.source_index.add, url, text, 'web', lemmas)
+            return text, lemmas
         except Exception as e:
             logger.error(f"Content extraction error: {e}")
-            return ""
+            # Устаревшая копия лучше, чем ничего
+            if cached:
+                return cached['text'], await self.run_cpu(self._page_lemmas, cached['text'])
+            return "", []
     
-    def _calculate_relevance(self, content: str, topic: str) -> float:
-        topic_words = set(self._normalize_text(topic).split())
-        content_words = set(self._normalize_text(content).split())
+    async def _fetch_page(self, url: str, validators=None):
+        """(html, ETag, Last-Modified) страницы; html = None при ответе 304.
         
+        Загружается не больше SOURCE_MAX_BYTES, остаток ответа не скачивается.
+        """
+        async with self._get_http_client().stream("GET", url, headers=validators) as response:
+            if response.status_code == 304:
+                return None, None, None
+            response.raise_for_status()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+            content_type = response.headers.get('Content-Type', 'text/html')
+            if 'html' not in content_type and 'text/plain' not in content_type:
+                logger.info(f"Skipping {url}: {content_type}")
+                return "", etag, last_modified
+            
+            chunks = []
+            size = 0
+            async for chunk in response.aiter_bytes():
+                chunks.append(chunk)
+                size += len(chunk)
+                if size >= SOURCE_MAX_BYTES:
+                    break
+            html = b"".join(chunks)[:SOURCE_MAX_BYTES].decode(response.encoding or 'utf-8', errors='replace')
+            return html, etag, last_modified
+    
+    def _html_to_text(self, html: str) -> str:
+        try:
+            text = extract_main_text(html)
+        except Exception as e:
+            logger.warning(f"lxml extraction error: {e}")
+            text = ""
+        # Страницы без абзацной разметки разбираем полностью
+        return text or extract_text_soup(html)
+    
+    def _page_lemmas(self, text: str) -> List[str]:
+        return [lemma for _, _, lemmas in self.normalizer.normalize_document(text) for lemma in lemmas]
+    
+    def _calculate_relevance(self, content_words: set, topic_words: set) -> float:
         if not topic_words or not content_words:
             return 0.0
         
         intersection = topic_words.intersection(content_words)
         return len(intersection) / len(topic_words)
     
-    def _normalize_text(self, text: str) -> str:
-        text = text.lower()
-        text = re.sub(r'[^\w\s]', ' ', text)
-        words = text.split()
-        normalized_words = []
-        
-        for word in words:
-            try:
-                if self.morph:
-                    parsed = self.morph.parse(word)[0]
-                    normalized_words.append(parsed.normal_form)
-                else:
-                    normalized_words.append(word)
-            except:
-                normalized_words.append(word)
-        
-        return ' '.join(normalized_words)
-    
     def _create_enhanced_prompt(self, work_type, topic, subject, methodic_info, sources):
         sources_text = ""
         if sources:
@@ -653,7 +2991,7 @@ class EnhancedAcademicWriter:
 2. ГРАММАТИКА: Идеальная грамматика, пунктуация и стиль
 3. НАУЧНОСТЬ: Используй точную терминологию
 4. СТРУКТУРА: Четкая логическая структура
-5. ОБЪЕМ: Не менее {self._get_target_word_count(work_type)} слов
+5. ОБЪЕМ: Вся работа не менее {self._get_target_word_count(work_type)} слов, соблюдай объем, указанный для раздела
 
 ЗАПРЕЩЕНО:
 - Использовать шаблонные фразы типа "В данной работе", "Актуальность темы заключается"
@@ -694,94 +3032,160 @@ class EnhancedAcademicWriter:
         }
         return word_counts.get(work_type, 6000)
     
-    def _enhance_content_quality(self, content: str, topic: str, subject: str) -> str:
-        sentences = re.split(r'(?<=[.!?])\s+', content)
+    def _sentence_hash(self, sentence: str) -> str:
+        return self._lemmas_hash(self.normalizer.normalize(sentence, limit=8))
+    
+    @staticmethod
+    def _lemmas_hash(lemmas) -> str:
+        return hashlib.md5(' '.join(lemmas[:8]).encode()).hexdigest()
+    
+    async def _process_sentence(self, sentence: str, seen_hashes: set):
+        """Хэш для дедупликации и исправленный текст предложения из потока.
         
-        unique_sentences = []
-        seen_hashes = set()
+        Предложение, хэш которого уже в seen_hashes, возвращается как None без
+        обработки. Штампы заменяются до проверки грамматики, чтобы модель
+        поправила стык замены с остальным текстом.
+        """
+        sentence_hash = await self.run_cpu(self._sentence_hash, sentence)
+        if sentence_hash in seen_hashes:
+            return sentence_hash, None
+        seen_hashes.add(sentence_hash)
+        sentence = await self.run_cpu(self._replace_cliches, sentence)
+        if len(sentence.split()) > 4:
+            sentence = await self.grammar_batcher.correct(sentence)
+        return sentence_hash, sentence
+    
+    def _process_sentences(self, document, seen_hashes: set):
+        """Хэши и исправленный текст предложений из normalize_document; грамматика - одним вызовом _correct_sentences.
         
-        for sentence in sentences:
-            if sentence.strip():
-                words = self._normalize_text(sentence).split()[:8]
-                sentence_hash = hashlib.md5(' '.join(words).encode()).hexdigest()
-                
-                if sentence_hash not in seen_hashes:
-                    seen_hashes.add(sentence_hash)
-                    
-                    improved_sentence = self._improve_sentence_quality(sentence)
-                    unique_sentences.append(improved_sentence)
+        Повторы по seen_hashes возвращаются как None и в пакет не попадают.
+        """
+        hashes = [self._lemmas_hash(lemmas) for _, _, lemmas in document]
+        fresh = []
+        for i, sentence_hash in enumerate(hashes):
+            if sentence_hash not in seen_hashes:
+                seen_hashes.add(sentence_hash)
+                fresh.append(i)
+        corrected = self._correct_sentences([self._replace_cliches(document[i][0]) for i in fresh])
+        sentences = [None] * len(document)
+        for i, sentence in zip(fresh, corrected):
+            sentences[i] = sentence
+        return list(zip(hashes, sentences))
+    
+    def _join_sentences(self, processed, seen_hashes) -> str:
+        """Собирает текст из обработанных предложений, отбрасывая повторы по хэшу."""
+        paragraphs = []
+        current = []
+        for sentence_hash, sentence, paragraph_end in processed:
+            if sentence is not None and sentence_hash not in seen_hashes:
+                seen_hashes.add(sentence_hash)
+                current.append(sentence)
+            if paragraph_end and current:
+                paragraphs.append(' '.join(current))
+                current = []
+        if current:
+            paragraphs.append(' '.join(current))
+        return '\n\n'.join(paragraphs)
+    
+    def _correct_sentences(self, sentences: List[str]) -> List[str]:
+        """Исправляет грамматику пакетами.
         
-        enhanced_text = ' '.join(unique_sentences)
+        Предложения длиннее 4 слов проходят быстрый отбор: признанные корректными
+        возвращаются без изменений. Остальные ищутся в кэше исправлений, а
+        промахи сортируются по числу токенов, чтобы в пакете было меньше выравнивания,
+        прогоняются через модель по GRAMMAR_BATCH_SIZE штук и возвращаются в
+        исходном порядке.
+        """
+        results = list(sentences)
+        indices = [i for i, sentence in enumerate(sentences) if len(sentence.split()) > 4]
+        if not indices or not self.grammar_checker:
+            return results
         
-        enhanced_text = self._replace_cliches(enhanced_text)
+        if self.grammar_triage:
+            indices = [i for i in indices if self.grammar_triage.needs_correction(sentences[i])]
+            if not indices:
+                return results
         
-        return enhanced_text
-    
-    def _improve_sentence_quality(self, sentence: str) -> str:
-        if len(sentence.split()) > 4 and self.grammar_checker:
+        cached = self.grammar_cache.get_many([sentences[i] for i in indices])
+        for i in indices:
+            if sentences[i] in cached:
+                results[i] = cached[sentences[i]]
+        indices = [i for i in indices if sentences[i] not in cached]
+        if not indices:
+            return results
+        
+        with self._grammar_lock:
+            lengths = self._token_lengths([sentences[i] for i in indices])
+        order = [indices[k] for k in sorted(range(len(indices)), key=lambda k: lengths[k])]
+        
+        for start in range(0, len(order), GRAMMAR_BATCH_SIZE):
+            batch = order[start:start + GRAMMAR_BATCH_SIZE]
             try:
-                result = self.grammar_checker(sentence, max_length=100, num_beams=2)[0]['generated_text']
-                return result
+                with self._grammar_lock:
+                    outputs = self.grammar_checker(
+                        [sentences[i] for i in batch], batch_size=len(batch), **GRAMMAR_GENERATION_PARAMS
+                    )
+                for i, output in zip(batch, outputs):
+                    if isinstance(output, list):
+                        output = output[0]
+                    results[i] = output['generated_text']
+                self.grammar_cache.set_many([(sentences[i], results[i]) for i in batch])
             except Exception as e:
                 logger.error(f"Grammar check error: {e}")
-                return sentence
-        return sentence
+        
+        return results
+    
+    def _token_lengths(self, sentences: List[str]) -> List[int]:
+        tokenizer = getattr(self.grammar_checker, 'tokenizer', None)
+        if tokenizer is None:
+            return [len(sentence) for sentence in sentences]
+        return [len(ids) for ids in tokenizer(sentences)['input_ids']]
     
     def _replace_cliches(self, text: str) -> str:
-        replacements = {
-            "в данной работе": "В исследовании",
-            "актуальность темы заключается": "Значимость изучения обусловлена",
-            "целью работы является": "Основной целью выступает",
-            "задачами работы являются": "Ключевыми задачами исследования определены",
-            "объектом исследования является": "В качестве объекта изучения рассматривается",
-            "предметом исследования является": "Предметная область охватывает",
-            "во введении": "В начальном разделе",
-            "в заключении": "В завершающей части",
-            "было выявлено": "Установлено",
-            "можно сделать вывод": "Следует заключить"
-        }
-        
-        for cliche, replacement in replacements.items():
-            text = re.sub(r'\b' + re.escape(cliche) + r'\b', replacement, text, flags=re.IGNORECASE)
+        return self.cliche_rewriter.rewrite(text)
+    
+    async def _make_api_call(self, system_prompt, user_prompt, max_tokens=8000, temperature=0.7, on_text=None, fresh=False):
+        """Запрос к DeepSeek через кэш ответов; fresh=True запрашивает новый вариант в обход кэша."""
+        cache_key = LLMResponseCache.make_key("deepseek-chat", temperature, system_prompt, user_prompt)
+        if not fresh:
+            cached = await asyncio.to_thread(self.response_cache.get, cache_key)
+            if cached is not None:
+                logger.info(f"LLM cache hit: {len(cached.split())} words")
+                if on_text:
+                    await on_text(cached)
+                return cached
         
-        return text
+        content = await self._request_completion(system_prompt, user_prompt, max_tokens, temperature, on_text)
+        if content and not content.startswith("❌") and not content.startswith("⏰"):
+            await asyncio.to_thread(self.response_cache.set, cache_key, content)
+        return content
     
-    def _make_api_call(self, system_prompt, user_prompt):
-        if not self.api_key:
+    async def _request_completion(self, system_prompt, user_prompt, max_tokens, temperature, on_text):
+        if not self.deepseek.api_key:
             logger.error("DeepSeek API key not configured")
             return "❌ Ошибка: API ключ DeepSeek не настроен"
         
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.api_key}"
-        }
-        
-        data = {
-            "model": "deepseek-chat",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            "temperature": 0.7,
-            "max_tokens": 8000
-        }
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
         
         try:
             logger.info(f"Sending request to DeepSeek API...")
-            response = requests.post(self.api_url, headers=headers, json=data, timeout=180)
-            response.raise_for_status()
-            result = response.json()
-            content = result['choices'][0]['message']['content']
+            content = await self.deepseek.complete(messages, max_tokens=max_tokens, temperature=temperature, on_text=on_text)
             
             word_count = len(content.split())
             logger.info(f"Received response: {word_count} words")
             
             return content
             
-        except requests.exceptions.Timeout:
+        except DeepSeekTimeout:
             logger.error("DeepSeek API timeout")
             return "⏰ Время ожидания истекло. Попробуйте еще раз."
-        except requests.exceptions.RequestException as e:
+        except DeepSeekUnavailable:
+            logger.error("DeepSeek API unavailable, circuit breaker is open")
+            return "❌ Сервис генерации временно недоступен. Попробуйте через минуту."
+        except DeepSeekError as e:
             logger.error(f"DeepSeek API request error: {e}")
             return "❌ Ошибка соединения с сервисом."
         except Exception as e:
@@ -792,7 +3196,8 @@ class WordDocumentGenerator:
     def __init__(self):
         self.doc = None
     
-    def create_document(self, work_type, topic, subject, content, methodic_info, student_info, teacher_info):
+    def create_document(self, work_type, topic, subject, content, methodic_info, student_info, teacher_info,
+                        section_titles=None):
         try:
             self.doc = Document()
             
@@ -800,7 +3205,7 @@ class WordDocumentGenerator:
             
             self._create_title_page(work_type, topic, subject, methodic_info, student_info, teacher_info)
             
-            self._create_table_of_contents(methodic_info)
+            self._create_table_of_contents(methodic_info, section_titles)
             
             self._add_main_content(content, methodic_info)
             
@@ -934,7 +3339,8 @@ class WordDocumentGenerator:
         except Exception as e:
             logger.error(f"Error creating title page: {e}")
     
-    def _create_table_of_contents(self, methodic_info):
+    def _create_table_of_contents(self, methodic_info, section_titles=None):
+        """Оглавление по заголовкам разделов работы (план генерации), а без них - по методичке."""
         try:
             toc_heading = self.doc.add_heading('СОДЕРЖАНИЕ', level=1)
             toc_heading.paragraph_format.space_after = Pt(12)
@@ -943,7 +3349,13 @@ class WordDocumentGenerator:
             required_sections = work_structure.get('required_sections', [])
             chapter_count = work_structure.get('chapter_count', 3)
             
-            if required_sections:
+            if section_titles:
+                # Список литературы добавляет _add_bibliography после основного текста
+                for title in list(section_titles) + ["Список литературы"]:
+                    paragraph = self.doc.add_paragraph()
+                    paragraph.add_run(title)
+                    paragraph.paragraph_format.space_after = Pt(6)
+            elif required_sections:
                 for section in required_sections:
                     paragraph = self.doc.add_paragraph()
                     paragraph.add_run(section)
@@ -965,21 +3377,18 @@ class WordDocumentGenerator:
             logger.error(f"Error creating table of contents: {e}")
     
     def _get_chapter_title(self, chapter_num):
-        titles = {
-            1: "Теоретические основы исследования",
-            2: "Практическое исследование",
-            3: "Анализ и выводы",
-            4: "Результаты и рекомендации",
-            5: "Перспективы развития"
-        }
-        return titles.get(chapter_num, f"Глава {chapter_num}")
+        return DEFAULT_CHAPTER_TITLES.get(chapter_num, f"Глава {chapter_num}")
     
     def _add_main_content(self, content, methodic_info):
         try:
             sections = self._split_into_sections(content, methodic_info)
             
             for i, section in enumerate(sections):
-                if i == 0:
+                first_line, _, body = section.partition('\n')
+                if HEADING_PATTERN.match(first_line.strip()):
+                    heading = self.doc.add_heading(first_line.strip().upper(), level=1)
+                    section = body
+                elif i == 0:
                     heading = self.doc.add_heading('ВВЕДЕНИЕ', level=1)
                 elif i == len(sections) - 1:
                     heading = self.doc.add_heading('ЗАКЛЮЧЕНИЕ', level=1)
@@ -1016,19 +3425,22 @@ class WordDocumentGenerator:
         for line in lines:
             line = line.strip()
             if not line:
+                # Пустая строка разделяет абзацы внутри раздела
+                if current_section and current_section[-1]:
+                    current_section.append('')
                 continue
                 
-            if any(keyword in line.lower() for keyword in ['введение', 'глава', 'заключение', 'список литературы']):
+            if HEADING_PATTERN.match(line):
                 if current_section:
-                    sections.append('\n'.join(current_section))
+                    sections.append('\n'.join(current_section).strip())
                     current_section = []
             
             current_section.append(line)
         
         if current_section:
-            sections.append('\n'.join(current_section))
+            sections.append('\n'.join(current_section).strip())
         
-        if len(sections) <= 1 or len(sections) < chapter_count + 2:
+        if len(sections) <= 1:
             words = content.split()
             total_sections = chapter_count + 2
             words_per_section = len(words) // total_sections
@@ -1064,12 +3476,329 @@ class WordDocumentGenerator:
         except Exception as e:
             logger.error(f"Error adding bibliography: {e}")
 
+class GenerationScheduler:
+    """Очередь задач генерации с ограничением параллелизма и справедливым порядком.
+    
+    У пользователя одновременно выполняется не больше одной задачи; пользователи
+    обслуживаются по кругу в порядке первой заявки, поэтому несколько заявок
+    одного студента не задерживают остальных. При переполнении очереди новые
+    заявки отклоняются.
+    """
+    def __init__(self, workers=GENERATION_WORKERS, max_queue=GENERATION_QUEUE_LIMIT, initial_duration=360.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.avg_duration = initial_duration
+        self.user_queues = {}
+        self.user_order = deque()
+        self.active_users = set()
+        self._condition = None
+        self._tasks = []
+        self._stopping = False
+    
+    def start(self):
+        if self._tasks:
+            return
+        self._stopping = False
+        self._condition = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    @property
+    def queue_size(self):
+        return sum(len(queue) for queue in self.user_queues.values())
+    
+    def estimate_wait(self, position):
+        """Оценка ожидания в секундах для задачи на позиции position (с 1)."""
+        free_workers = self.workers - len(self.active_users)
+        if position <= free_workers:
+            return 0.0
+        return -(-(position - max(free_workers, 0)) // self.workers) * self.avg_duration
+    
+    async def submit(self, user_id, run, on_position=None, on_failure=None):
+        """Ставит задачу в очередь. Возвращает позицию и ожидание или None, если очередь полна.
+        
+        on_failure вызывается, если задача завершилась исключением или была отменена.
+        """
+        self.start()
+        if self.queue_size >= self.max_queue:
+            return None
+        
+        job = {'user_id': user_id, 'run': run, 'on_position': on_position, 'on_failure': on_failure}
+        async with self._condition:
+            if user_id not in self.user_queues:
+                self.user_queues[user_id] = deque()
+                self.user_order.append(user_id)
+            self.user_queues[user_id].append(job)
+            self._condition.notify()
+        
+        position = self._positions().get(id(job), 0)
+        return {'position': position, 'eta': self.estimate_wait(position)}
+    
+    def _positions(self):
+        """Позиции ожидающих задач в порядке, в котором их заберут обработчики."""
+        queues = {user_id: list(queue) for user_id, queue in self.user_queues.items()}
+        positions = {}
+        position = 0
+        while any(queues.values()):
+            for user_id in self.user_order:
+                if queues.get(user_id):
+                    position += 1
+                    positions[id(queues[user_id].pop(0))] = position
+        return positions
+    
+    def _pop_next(self):
+        for _ in range(len(self.user_order)):
+            user_id = self.user_order[0]
+            self.user_order.rotate(-1)
+            if user_id in self.active_users:
+                continue
+            queue = self.user_queues[user_id]
+            job = queue.popleft()
+            if not queue:
+                del self.user_queues[user_id]
+                self.user_order.remove(user_id)
+            self.active_users.add(user_id)
+            return job
+        return None
+    
+    async def _notify_positions(self):
+        positions = self._positions()
+        for queue in list(self.user_queues.values()):
+            for job in list(queue):
+                if job['on_position']:
+                    position = positions.get(id(job), 0)
+                    try:
+                        await job['on_position'](position, self.estimate_wait(position))
+                    except Exception as e:
+                        logger.warning(f"Queue position update error: {e}")
+    
+    async def _notify_failure(self, job):
+        if job['on_failure']:
+            try:
+                await job['on_failure']()
+            except Exception as e:
+                logger.warning(f"Queue failure notification error: {e}")
+    
+    async def _worker(self):
+        while True:
+            async with self._condition:
+                job = self._pop_next()
+                while job is None:
+                    await self._condition.wait()
+                    job = self._pop_next()
+            
+            await self._notify_positions()
+            started_at = time.monotonic()
+            try:
+                await job['run']()
+            except asyncio.CancelledError:
+                # Останавливается сам обработчик (stop); иначе отменено что-то внутри задачи,
+                # и обработчик продолжает брать следующие задачи
+                if self._stopping:
+                    raise
+                logger.error(f"Generation job for user {job['user_id']} was cancelled")
+                await self._notify_failure(job)
+            except Exception as e:
+                logger.error(f"Generation job error: {e}")
+                await self._notify_failure(job)
+            finally:
+                self.avg_duration = 0.8 * self.avg_duration + 0.2 * (time.monotonic() - started_at)
+                async with self._condition:
+                    self.active_users.discard(job['user_id'])
+                    self._condition.notify_all()
+            await self._notify_positions()
+
+class MethodicIngestionQueue:
+    """Фоновая обработка загруженных методичек.
+    
+    Этапы задачи: download (файл скачивается и одновременно хэшируется),
+    hash (поиск уже разобранной методички с тем же содержимым), extract
+    (текст), analyze (поля методички), persist (запись в methodics). Этап и
+    состояние задачи хранятся в таблице methodic_jobs, поэтому незавершенные
+    задачи продолжаются после перезапуска; скачанный файл повторно не
+    загружается. Одновременно выполняется не больше workers задач, сообщение
+    "🔄 Анализирую методичку..." обновляется после каждого этапа.
+    """
+    STAGES = [
+        ('download', "Загрузка файла"),
+        ('hash', "Проверка на повторную загрузку"),
+        ('extract', "Извлечение текста"),
+        ('analyze', "Анализ требований"),
+        ('persist', "Сохранение"),
+    ]
+    
+    def __init__(self, db, doc_processor, info_from_row, workers=METHODIC_WORKERS,
+                 max_queue=METHODIC_QUEUE_LIMIT, max_attempts=METHODIC_JOB_ATTEMPTS):
+        self.db = db
+        self.doc_processor = doc_processor
+        self.info_from_row = info_from_row
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_attempts = max_attempts
+        self.bot = None
+        self._queue = None
+        self._tasks = []
+    
+    def start(self, bot):
+        """Запускает обработчики и возвращает в очередь задачи, прерванные остановкой бота."""
+        if self._tasks:
+            return
+        self.bot = bot
+        self._queue = asyncio.Queue()
+        for job_id in self.db.get_unfinished_methodic_jobs():
+            self._queue.put_nowait(job_id)
+        if self._queue.qsize():
+            logger.info(f"Resuming {self._queue.qsize()} methodic jobs")
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+    
+    def submit(self, job_id):
+        """Ставит задачу в очередь. Возвращает False, если очередь полна."""
+        if self._queue is None or self._queue.qsize() >= self.max_queue:
+            self.db.update_methodic_job(job_id, status='failed', error='queue is full')
+            return False
+        self._queue.put_nowait(job_id)
+        return True
+    
+    def _progress_text(self, done_stage):
+        names = [name for name, _ in self.STAGES]
+        done = names.index(done_stage) + 1 if done_stage in names else 0
+        lines = ["🔄 Анализирую методичку...", ""]
+        for index, (_, title) in enumerate(self.STAGES):
+            mark = "✅" if index < done else "⏳" if index == done else "▫️"
+            lines.append(f"{mark} {title}")
+        return "\n".join(lines)
+    
+    @staticmethod
+    def _summary_text(methodic_info):
+        university = methodic_info['university']
+        return (
+            f"✅ <b>Методичка успешно обработана!</b>\n\n"
+            f"📋 <b>Извлеченные данные:</b>\n"
+            f"🏫 <b>Учебное заведение:</b>\n"
+            f"• Название: {university.get('university_name', '')}\n"
+            f"• Адрес: {university.get('university_address', '')}\n"
+            f"• Факультет: {university.get('faculty', '')}\n"
+            f"• Кафедра: {university.get('department', '')}\n\n"
+            f"📝 <b>Структура работы:</b>\n"
+            f"• Разделы: {', '.join(methodic_info['work_structure'].get('required_sections', []))}\n"
+            f"• Глав: {methodic_info['work_structure'].get('chapter_count', 3)}\n\n"
+            f"Теперь начните создание работы через /start"
+        )
+    
+    async def _notify(self, job, text, parse_mode=None):
+        try:
+            await self.bot.edit_message_text(
+                text, chat_id=job['chat_id'], message_id=job['message_id'], parse_mode=parse_mode
+            )
+        except Exception as e:
+            logger.warning(f"Methodic job {job['id']} status update error: {e}")
+    
+    async def _advance(self, job, stage, **fields):
+        await asyncio.to_thread(self.db.update_methodic_job, job['id'], stage=stage, **fields)
+        job.update(fields, stage=stage)
+        await self._notify(job, self._progress_text(stage))
+    
+    async def _run(self, job):
+        # Файл уже скачан до перезапуска: начинаем с проверки хэша
+        if not (job['file_path'] and os.path.exists(job['file_path'])):
+            telegram_file = await self.bot.get_file(job['file_id'])
+            file_path, content_hash = await self.doc_processor.store_upload(telegram_file, job['file_extension'])
+            await self._advance(job, 'download', file_path=file_path, content_hash=content_hash)
+        
+        existing = await asyncio.to_thread(self.db.get_methodic_by_hash, job['content_hash'])
+        if existing:
+            logger.info(f"Methodic {job['content_hash'][:12]} already processed as #{existing[0]}")
+            await asyncio.to_thread(self.db.update_methodic_job, job['id'], stage='persist', status='done', methodic_id=existing[0])
+            return self.info_from_row(existing)
+        await self._advance(job, 'hash')
+        
+        text = await self.doc_processor.extract_methodic_text(job['file_path'])
+        if not text:
+            return None
+        await self._advance(job, 'extract')
+        
+        methodic_info = await asyncio.to_thread(self.doc_processor.extract_methodic_info, text)
+        await self._advance(job, 'analyze')
+        
+        methodic_id = await asyncio.to_thread(
+            self.db.add_methodic,
+            filename=job['filename'],
+            file_path=job['file_path'],
+            university_name=methodic_info['university'].get('university_name', ''),
+            university_address=methodic_info['university'].get('university_address', ''),
+            faculty=methodic_info['university'].get('faculty', ''),
+            department=methodic_info['university'].get('department', ''),
+            work_structure=methodic_info['work_structure'],
+            formatting_style=methodic_info['formatting_style'],
+            user_id=job['user_id'],
+            content_hash=job['content_hash']
+        )
+        if methodic_id is None:
+            return None
+        await asyncio.to_thread(self.db.update_methodic_job, job['id'], stage='persist', status='done', methodic_id=methodic_id)
+        return methodic_info
+    
+    async def _process(self, job_id):
+        job = await asyncio.to_thread(self.db.get_methodic_job, job_id)
+        if not job or job['status'] not in ('queued', 'running'):
+            return
+        
+        # Задача, которая уже падала или прерывалась max_attempts раз, больше не запускается
+        if job['attempts'] >= self.max_attempts:
+            await asyncio.to_thread(self.db.update_methodic_job, job_id, status='failed', error=job['error'] or 'too many attempts')
+            await self._notify(job, "❌ Не удалось обработать методичку")
+            return
+        await asyncio.to_thread(self.db.update_methodic_job, job_id, status='running', attempts=job['attempts'] + 1)
+        downloaded = bool(job['file_path'] and os.path.exists(job['file_path']))
+        await self._notify(job, self._progress_text('download' if downloaded else None))
+        
+        try:
+            methodic_info = await self._run(job)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"Methodic job {job_id} error after stage {job['stage']}: {e}")
+            await asyncio.to_thread(self.db.update_methodic_job, job_id, status='failed', error=str(e))
+            await self._notify(job, "❌ Ошибка обработки методички")
+            return
+        
+        if not methodic_info:
+            await asyncio.to_thread(self.db.update_methodic_job, job_id, status='failed', error='no methodic info')
+            await self._notify(job, "❌ Не удалось обработать методичку")
+            return
+        await self._notify(job, self._summary_text(methodic_info), parse_mode='HTML')
+    
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._process(job_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Methodic queue error: {e}")
+            finally:
+                self._queue.task_done()
+
 class EnhancedCourseworkBot:
     def __init__(self):
         self.db = Database()
-        self.doc_processor = DocumentProcessor()
         self.writer = EnhancedAcademicWriter()
-        self.doc_generator = WordDocumentGenerator()
+        self.doc_processor = DocumentProcessor(self.writer.source_index)
+        self.scheduler = GenerationScheduler()
+        self.methodic_queue = MethodicIngestionQueue(self.db, self.doc_processor, self._methodic_info_from_row)
         self.user_sessions = {}
         self.quality_metrics = {}
     
@@ -1108,6 +3837,7 @@ class EnhancedCourseworkBot:
         
         if data.startswith('work_'):
             work_type = data.split('_')[1]
+            self._cancel_prefetch(user_id)
             self.user_sessions[user_id] = {
                 'work_type': work_type,
                 'stage': 'subject'
@@ -1167,6 +3897,8 @@ class EnhancedCourseworkBot:
                 
             session['topic'] = user_message
             session['stage'] = 'student_name'
+            # Источники ищутся, пока пользователь вводит ФИО, группу и преподавателя
+            session['sources_task'] = self.writer.prefetch_sources(user_message, session['subject'])
             self.user_sessions[user_id] = session
             
             await update.message.reply_text(
@@ -1232,6 +3964,7 @@ class EnhancedCourseworkBot:
     
     async def start_work_generation(self, update, session, methodic_info):
         user_id = update.effective_user.id if hasattr(update, 'effective_user') else update.from_user.id
+        message_obj = update.message if hasattr(update, 'message') else update
         
         try:
             student_info = {
@@ -1243,80 +3976,124 @@ class EnhancedCourseworkBot:
                 'full_name': session.get('teacher_name', 'Преподаватель')
             }
             
-            work_id = self.db.create_work(
-                user_id=user_id,
-                work_type=session['work_type'],
-                topic=session['topic'],
-                subject=session['subject'],
-                methodic_info=methodic_info,
-                student_info=student_info,
-                teacher_info=teacher_info
-            )
-            session['work_id'] = work_id
             session['student_info'] = student_info
             session['teacher_info'] = teacher_info
             self.user_sessions[user_id] = session
             
-            await self.generate_complete_work(update, session)
+            status_msg = await message_obj.reply_text("⏳ Ставлю работу в очередь...")
+            
+            async def run():
+                work_id = self.db.create_work(
+                    user_id=user_id,
+                    work_type=session['work_type'],
+                    topic=session['topic'],
+                    subject=session['subject'],
+                    methodic_info=methodic_info,
+                    student_info=student_info,
+                    teacher_info=teacher_info
+                )
+                session['work_id'] = work_id
+                await self.generate_complete_work(update, session, status_msg)
+            
+            async def on_position(position, eta):
+                await self._edit_queue_status(status_msg, position, eta)
+            
+            async def on_failure():
+                await status_msg.edit_text("❌ Генерация работы прервалась. Попробуйте еще раз через /start")
+            
+            ticket = await self.scheduler.submit(user_id, run, on_position, on_failure)
+            if ticket is None:
+                eta_minutes = max(1, round(self.scheduler.estimate_wait(self.scheduler.queue_size + 1) / 60))
+                await status_msg.edit_text(
+                    "❌ <b>Сейчас слишком много заявок на генерацию.</b>\n\n"
+                    f"⏱️ Место в очереди освободится примерно через {eta_minutes} мин. Попробуйте позже.",
+                    parse_mode='HTML'
+                )
+            else:
+                # Поиск источников теперь нужен задаче генерации: кнопки его не отменяют
+                session['sources_owned'] = True
+                await self._edit_queue_status(status_msg, ticket['position'], ticket['eta'])
         except Exception as e:
             logger.error(f"Error starting work generation: {e}")
             await self._send_error_message(update, "Ошибка при начале генерации работы")
     
-    async def generate_complete_work(self, update, session):
+    async def _edit_queue_status(self, status_msg, position, eta):
+        # Задача, для которой есть свободный обработчик, сразу сама обновит сообщение
+        if position <= 0 or eta <= 0:
+            return
+        try:
+            await status_msg.edit_text(
+                "⏳ <b>Работа поставлена в очередь</b>\n\n"
+                f"📍 Позиция в очереди: {position}\n"
+                f"⏱️ Примерное ожидание: {max(1, round(eta / 60))} мин",
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.warning(f"Queue status edit error: {e}")
+    
+    async def generate_complete_work(self, update, session, progress_msg=None):
         message_obj = update.message if hasattr(update, 'message') else update
         
         try:
-            progress_msg = await message_obj.reply_text(
+            start_text = (
                 "🔬 <b>Запускаю интеллектуальную генерацию работы...</b>\n\n"
                 "📊 Этапы обработки:\n"
                 "1. 🔍 Поиск научных источников\n"
                 "2. 📝 Создание уникального текста\n"
                 "3. ✅ Проверка грамматики и стиля\n"
                 "4. 🎨 Применение оформления\n\n"
-                "⏱️ Время обработки: 5-8 минут",
-                parse_mode='HTML'
+                "⏱️ Время обработки: 5-8 минут"
             )
+            if progress_msg:
+                await progress_msg.edit_text(start_text, parse_mode='HTML')
+            else:
+                progress_msg = await message_obj.reply_text(start_text, parse_mode='HTML')
             
-            await progress_msg.edit_text(
-                "🔄 <b>Этап 1/4: Поиск научных источников...</b>\n"
-                "🔍 Ищу релевантные исследования и публикации...",
-                parse_mode='HTML'
-            )
+            async def report_progress(stage, details):
+                await self._edit_progress(progress_msg, stage, details)
             
             methodic_info = session.get('methodic_info', {})
+            section_titles = []
             
-            full_content = self.writer.generate_complete_work(
+            full_content = await self.writer.generate_complete_work(
                 work_type=session['work_type'],
                 topic=session['topic'],
                 subject=session['subject'],
-                methodic_info=methodic_info
+                methodic_info=methodic_info,
+                progress=report_progress,
+                fresh=session.get('fresh_variant', False),
+                prefetched_sources=session.get('sources_task'),
+                outline_titles=section_titles
             )
             
             if full_content.startswith("❌") or full_content.startswith("⏰"):
                 await progress_msg.edit_text(f"❌ Не удалось создать работу: {full_content}")
                 return
             
-            quality_report = self._analyze_quality(full_content, session['topic'])
+            quality_report = await self.writer.run_cpu(self._analyze_quality, full_content, session['topic'])
             
-            await progress_msg.edit_text(
-                "🔄 <b>Этап 3/4: Создание Word документа...</b>\n"
+            await self._edit_progress(
+                progress_msg, 4,
                 "📊 Качество текста проверено:\n"
                 f"• ✨ Уникальность: {quality_report.get('uniqueness', 'высокая')}\n"
                 f"• ✅ Грамматика: {quality_report.get('grammar', 'отличная')}\n"
-                f"• 🎓 Научность: {quality_report.get('academic_level', 'высокая')}",
-                parse_mode='HTML'
+                f"• 🎓 Научность: {quality_report.get('academic_level', 'высокая')}"
             )
             
             self.db.update_work_content(session['work_id'], full_content)
             
-            doc_stream = self.doc_generator.create_document(
+            # Отдельный генератор на каждую работу: он хранит состояние документа
+            doc_generator = WordDocumentGenerator()
+            doc_stream = await self.writer.run_cpu(
+                doc_generator.create_document,
                 work_type=session['work_type'],
                 topic=session['topic'],
                 subject=session['subject'],
                 content=full_content,
                 methodic_info=methodic_info,
                 student_info=session.get('student_info'),
-                teacher_info=session.get('teacher_info')
+                teacher_info=session.get('teacher_info'),
+                section_titles=section_titles
             )
             
             if not doc_stream:
@@ -1340,6 +4117,21 @@ class EnhancedCourseworkBot:
             logger.error(f"Enhanced generation error: {e}")
             await self._send_error_message(update, "Ошибка при интеллектуальной генерации")
     
+    async def _edit_progress(self, progress_msg, stage, details):
+        titles = {
+            1: "Поиск научных источников",
+            2: "Создание уникального текста",
+            3: "Проверка грамматики и стиля",
+            4: "Создание Word документа"
+        }
+        try:
+            await progress_msg.edit_text(
+                f"🔄 <b>Этап {stage}/4: {titles.get(stage, 'Обработка')}...</b>\n{details}",
+                parse_mode='HTML'
+            )
+        except Exception as e:
+            logger.warning(f"Progress edit error: {e}")
+    
     def _analyze_quality(self, content: str, topic: str) -> Dict:
         words = content.split()
         sentences = re.split(r'[.!?]+', content)
@@ -1365,9 +4157,9 @@ class EnhancedCourseworkBot:
     def _count_grammar_errors(self, text: str) -> int:
         errors = 0
         
-        errors += len(re.findall(r'\b\w+ (?:был|была|было|были) \w+ть\b', text))
+        errors += len(PASSIVE_INFINITIVE_PATTERN.findall(text))
         
-        errors += len(re.findall(r'[а-яё][А-ЯЁ]', text))
+        errors += len(CASE_BREAK_PATTERN.findall(text))
         
         sentences = text.split('.')
         for i in range(1, len(sentences)):
@@ -1413,7 +4205,10 @@ class EnhancedCourseworkBot:
             "<i>Работа соответствует требованиям академического письма</i>"
         )
         
-        await message_obj.reply_text(report_text, parse_mode='HTML')
+        keyboard = [[InlineKeyboardButton("🔄 Другой вариант текста", callback_data="fresh_variant")]]
+        reply_markup = InlineKeyboardMarkup(keyboard)
+        
+        await message_obj.reply_text(report_text, reply_markup=reply_markup, parse_mode='HTML')
     
     def _get_work_name(self, work_type):
         names = {
@@ -1441,47 +4236,7 @@ class EnhancedCourseworkBot:
             methodic_data = self.db.get_methodic(methodic_id)
             if methodic_data:
                 try:
-                    work_structure = {}
-                    formatting_style = {}
-                    
-                    if methodic_data[6]:
-                        try:
-                            work_structure = json.loads(methodic_data[6])
-                        except (json.JSONDecodeError, TypeError):
-                            logger.warning(f"Invalid work_structure JSON for methodic {methodic_id}")
-                            work_structure = {
-                                'required_sections': ['Введение', 'Основная часть', 'Заключение', 'Список литературы'],
-                                'chapter_count': 3,
-                                'has_introduction': True,
-                                'has_conclusion': True,
-                                'has_bibliography': True
-                            }
-                    
-                    if methodic_data[7]:
-                        try:
-                            formatting_style = json.loads(methodic_data[7])
-                        except (json.JSONDecodeError, TypeError):
-                            logger.warning(f"Invalid formatting_style JSON for methodic {methodic_id}")
-                            formatting_style = {
-                                'font_family': 'Times New Roman',
-                                'font_size': '14',
-                                'line_spacing': '1.5',
-                                'margin_left': '3',
-                                'margin_right': '1',
-                                'margin_top': '2',
-                                'margin_bottom': '2'
-                            }
-                    
-                    methodic_info = {
-                        'university': {
-                            'university_name': methodic_data[2] or "Федеральное государственное автономное образовательное учреждение высшего образования",
-                            'university_address': methodic_data[3] or "г. Москва, ул. Примерная, д. 123",
-                            'faculty': methodic_data[4] or "Факультет информационных технологий",
-                            'department': methodic_data[5] or "Кафедра информатики и вычислительной техники"
-                        },
-                        'work_structure': work_structure,
-                        'formatting_style': formatting_style,
-                    }
+                    methodic_info = self._methodic_info_from_row(methodic_data)
                     
                     session['methodic_info'] = methodic_info
                     session['methodic_id'] = methodic_id
@@ -1521,6 +4276,51 @@ class EnhancedCourseworkBot:
             else:
                 await query.message.reply_text("❌ Методичка не найдена в базе данных")
     
+    def _methodic_info_from_row(self, methodic_data):
+        """methodic_info из строки таблицы methodics (id, filename, file_path, university_name, ...)."""
+        work_structure = {}
+        formatting_style = {}
+        
+        if methodic_data[7]:
+            try:
+                work_structure = json.loads(methodic_data[7])
+            except (json.JSONDecodeError, TypeError):
+                logger.warning(f"Invalid work_structure JSON for methodic {methodic_data[0]}")
+                work_structure = {
+                    'required_sections': ['Введение', 'Основная часть', 'Заключение', 'Список литературы'],
+                    'chapter_count': 3,
+                    'has_introduction': True,
+                    'has_conclusion': True,
+                    'has_bibliography': True
+                }
+        
+        if methodic_data[8]:
+            try:
+                formatting_style = json.loads(methodic_data[8])
+            except (json.JSONDecodeError, TypeError):
+                logger.warning(f"Invalid formatting_style JSON for methodic {methodic_data[0]}")
+                formatting_style = {
+                    'font_family': 'Times New Roman',
+                    'font_size': '14',
+                    'line_spacing': '1.5',
+                    'margin_left': '3',
+                    'margin_right': '1',
+                    'margin_top': '2',
+                    'margin_bottom': '2'
+                }
+        
+        methodic_info = {
+            'university': {
+                'university_name': methodic_data[3] or "Федеральное государственное автономное образовательное учреждение высшего образования",
+                'university_address': methodic_data[4] or "г. Москва, ул. Примерная, д. 123",
+                'faculty': methodic_data[5] or "Факультет информационных технологий",
+                'department': methodic_data[6] or "Кафедра информатики и вычислительной техники"
+            },
+            'work_structure': work_structure,
+            'formatting_style': formatting_style,
+        }
+        return methodic_info
+    
     async def handle_document(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
         
@@ -1538,60 +4338,54 @@ class EnhancedCourseworkBot:
                 await update.message.reply_text("❌ Файл слишком большой. Максимальный размер - 20MB")
                 return
             
-            file = await context.bot.get_file(document.file_id)
-            file_path = os.path.join("методички", filename)
-            await file.download_to_drive(file_path)
-            
             processing_msg = await update.message.reply_text("🔄 Анализирую методичку...")
             
-            methodic_info = await self.doc_processor.process_methodic(file_path)
-            
-            if not methodic_info:
-                await processing_msg.edit_text("❌ Не удалось обработать методичку")
-                return
-            
-            methodic_id = self.db.add_methodic(
+            # Разбор идет в фоне: обработчик загрузки сразу освобождается
+            job_id = self.db.add_methodic_job(
+                user_id=user_id,
+                chat_id=processing_msg.chat_id,
+                message_id=processing_msg.message_id,
+                file_id=document.file_id,
                 filename=filename,
-                file_path=file_path,
-                university_name=methodic_info['university'].get('university_name', ''),
-                university_address=methodic_info['university'].get('university_address', ''),
-                faculty=methodic_info['university'].get('faculty', ''),
-                department=methodic_info['university'].get('department', ''),
-                work_structure=methodic_info['work_structure'],
-                formatting_style=methodic_info['formatting_style'],
-                user_id=user_id
-            )
-            
-            university = methodic_info['university']
-            await processing_msg.edit_text(
-                f"✅ <b>Методичка успешно обработана!</b>\n\n"
-                f"📋 <b>Извлеченные данные:</b>\n"
-                f"🏫 <b>Учебное заведение:</b>\n"
-                f"• Название: {university.get('university_name', '')}\n"
-                f"• Адрес: {university.get('university_address', '')}\n"
-                f"• Факультет: {university.get('faculty', '')}\n"
-                f"• Кафедра: {university.get('department', '')}\n\n"
-                f"📝 <b>Структура работы:</b>\n"
-                f"• Разделы: {', '.join(methodic_info['work_structure'].get('required_sections', []))}\n"
-                f"• Глав: {methodic_info['work_structure'].get('chapter_count', 3)}\n\n"
-                f"Теперь начните создание работы через /start",
-                parse_mode='HTML'
+                file_extension=file_extension
             )
+            if not self.methodic_queue.submit(job_id):
+                await processing_msg.edit_text("⏰ Сейчас обрабатывается слишком много методичек. Попробуйте через несколько минут")
             
         except Exception as e:
             logger.error(f"Upload error: {e}")
             await update.message.reply_text("❌ Ошибка загрузки файла")
     
+    async def handle_fresh_variant(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        query = update.callback_query
+        await query.answer()
+        
+        session = self.user_sessions.get(query.from_user.id, {})
+        if not session.get('topic'):
+            await query.message.reply_text("🤔 Пожалуйста, начните с команды /start")
+            return
+        
+        # Новый вариант генерируется в обход кэша ответов модели
+        session['fresh_variant'] = True
+        await self.start_work_generation(query, session, session.get('methodic_info'))
+    
     async def handle_new_work(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         query = update.callback_query
         await query.answer()
         
         user_id = query.from_user.id
         if user_id in self.user_sessions:
+            self._cancel_prefetch(user_id)
             del self.user_sessions[user_id]
         
         await self.start(query, context)
     
+    def _cancel_prefetch(self, user_id):
+        session = self.user_sessions.get(user_id, {})
+        task = session.get('sources_task')
+        if task and not task.done() and not session.get('sources_owned'):
+            task.cancel()
+    
     async def _send_error_message(self, update, message):
         try:
             if hasattr(update, 'message'):
@@ -1613,6 +4407,18 @@ class EnhancedCourseworkBot:
         except Exception as e:
             logger.error(f"Error in error handler: {e}")
     
+    async def post_init(self, application):
+        self.scheduler.start()
+        self.methodic_queue.start(application.bot)
+        # Прогрев запускается и с пустым WARMUP_MODELS: /ready ждет его завершения
+        model_registry.warm_up(WARMUP_MODELS)
+    
+    async def post_shutdown(self, application):
+        await self.scheduler.stop()
+        await self.methodic_queue.stop()
+        await self.writer.close()
+        self.doc_processor.close()
+    
     def run(self):
         if not BOT_TOKEN:
             logger.error("❌ BOT_TOKEN не найден!")
@@ -1622,12 +4428,20 @@ class EnhancedCourseworkBot:
             logger.warning("⚠️ DEEPSEEK_API_KEY не найден! Бот будет работать с ограничениями.")
         
         try:
-            application = Application.builder().token(BOT_TOKEN).build()
+            application = (
+                Application.builder()
+                .token(BOT_TOKEN)
+                .concurrent_updates(True)
+                .post_init(self.post_init)
+                .post_shutdown(self.post_shutdown)
+                .build()
+            )
             
             application.add_handler(CommandHandler("start", self.start))
             application.add_handler(CallbackQueryHandler(self.handle_button, pattern="^(work_|upload_methodic)"))
             application.add_handler(CallbackQueryHandler(self.handle_methodic_selection, pattern="^(methodic_|no_methodic)"))
             application.add_handler(CallbackQueryHandler(self.handle_new_work, pattern="^new_work$"))
+            application.add_handler(CallbackQueryHandler(self.handle_fresh_variant, pattern="^fresh_variant$"))
             application.add_handler(MessageHandler(filters.Document.ALL, self.handle_document))
             application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_text))
             application.add_error_handler(self.error_handler)